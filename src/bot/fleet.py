@@ -0,0 +1,257 @@
+import os
+import re
+import json
+import time
+import bisect
+import hashlib
+import threading
+import multiprocessing
+from queue import Empty
+from collections import OrderedDict
+from telegram import Update
+from telegram.ext import TypeHandler, DispatcherHandlerStop
+from bot.telegram_bot import setup_bot
+from utils import portfolio
+from utils.sheets_scheduler import get_queue_depth, set_worker_queue_depths
+from utils.custom_logger import get_custom_logger
+
+logger = get_custom_logger(__name__)
+
+HEARTBEAT_INTERVAL = 5  # Seconds between worker health reports
+HEARTBEAT_TIMEOUT = int(os.getenv("WORKER_HEARTBEAT_TIMEOUT", "30"))
+HEALTH_LOG_INTERVAL = 60
+VIRTUAL_NODES = 100  # Points per worker on the hash ring, to spread customers evenly
+MAX_UPDATE_RESENDS = 3  # An update still unfinished after this many worker restarts is dropped, so it cannot crash workers forever
+
+# Read-only and portfolio-wide commands are answered by the intake process itself; /CP is applied here once
+# and the workers pick the new percent up from the percent file
+LOCAL_COMMANDS = {"start", "ls", "rc", "summary", "cp", "qs"}
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode()).hexdigest(), 16)
+
+
+class HashRing:
+    def __init__(self):
+        self.points = []
+        self.owners = {}
+
+    def add(self, node):
+        for replica in range(VIRTUAL_NODES):
+            point = _hash(f"{node}-{replica}")
+            bisect.insort(self.points, point)
+            self.owners[point] = node
+
+    def get(self, key):
+        if not self.points:
+            return None
+
+        index = bisect.bisect(self.points, _hash(key)) % len(self.points)
+        return self.owners[self.points[index]]
+
+
+def parse_routing_key(update):
+    # Return the lowercased command and the customer name it targets, falling back to the chat ID
+    match = re.match(r'/(\w+)(?:@\w+)?\s*(\w*)', update.message.text or "")
+
+    if not match:
+        return None, str(update.message.chat_id)
+
+    command, customer = match.groups()
+    return command.lower(), customer.lower() or str(update.message.chat_id)
+
+
+def run_worker(worker_id, task_queue, status_queue):
+    # Send portfolio updates to the intake process, which owns the aggregates
+    portfolio.forward_events(lambda event: status_queue.put(("portfolio", worker_id, event)))
+
+    updater = setup_bot()
+    dispatcher = updater.dispatcher
+    processed = 0
+
+    def report_health():
+        while True:
+            status_queue.put(("heartbeat", worker_id, {"processed": processed, "queue_depth": get_queue_depth()}))
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    threading.Thread(target=report_health, daemon=True).start()
+    logger.info(f"Worker {worker_id} is ready for updates")
+
+    while True:
+        data = task_queue.get()
+
+        if data is None:
+            break
+
+        update = Update.de_json(json.loads(data), updater.bot)
+        dispatcher.process_update(update)  # Handlers run one at a time, keeping each customer's commands in order
+
+        processed += 1
+        status_queue.put(("done", worker_id, update.update_id))
+
+
+class WorkerFleet:
+    def __init__(self, worker_count):
+        # Spawn rather than fork, since the intake process already runs threads
+        self.context = multiprocessing.get_context("spawn")
+        self.status_queue = self.context.Queue()
+        self.worker_count = worker_count
+        self.workers = {}
+        self.ring = HashRing()
+        self.lock = threading.Lock()
+
+    def _start_worker(self, worker_id):
+        task_queue = self.context.Queue()
+        process = self.context.Process(target=run_worker, args=(worker_id, task_queue, self.status_queue), daemon=True)
+        process.start()
+
+        self.workers[worker_id] = {
+            "process": process,
+            "queue": task_queue,
+            "outstanding": OrderedDict(),  # update_id -> (routing key, data, resends), until the worker reports it done
+            "last_heartbeat": time.monotonic(),
+            "processed": 0,
+            "queue_depth": None  # Google Sheets queue depth from the latest heartbeat
+        }
+
+    def start(self):
+        for worker_id in range(self.worker_count):
+            self._start_worker(worker_id)
+            self.ring.add(worker_id)
+
+        threading.Thread(target=self._monitor, daemon=True).start()
+        logger.info(f"Started {self.worker_count} worker processes")
+
+    def _send(self, worker_id, update_id, key, data, resends=0):
+        worker = self.workers[worker_id]
+        worker["outstanding"][update_id] = (key, data, resends)
+        worker["queue"].put(data)
+
+    def route(self, update):
+        # Return False when no worker is alive, so the intake handles the update itself
+        _, key = parse_routing_key(update)
+        data = update.to_json()
+
+        with self.lock:
+            worker_id = self.ring.get(key)
+
+            if worker_id is None:
+                return False
+
+            self._send(worker_id, update.update_id, key, data)
+            return True
+
+    def _restart(self, worker_id):
+        # Replace a dead worker with a new process under the same ID, so it keeps its customers on the ring,
+        # and resend its unfinished updates in their original order
+        with self.lock:
+            worker = self.workers[worker_id]
+
+            if worker["process"].is_alive():
+                worker["process"].terminate()
+
+            self._start_worker(worker_id)
+            resent = 0
+
+            for update_id, (key, data, resends) in worker["outstanding"].items():
+                if resends >= MAX_UPDATE_RESENDS:
+                    logger.error(f"Dropping update {update_id} after {resends} worker restarts")
+                    continue
+
+                # Ledger commands are journaled, so a resend is safe
+                self._send(worker_id, update_id, key, data, resends + 1)
+                resent += 1
+
+        logger.error(f"Worker {worker_id} stopped responding; restarted it and resent {resent} pending updates")
+
+    def get_health(self):
+        with self.lock:
+            now = time.monotonic()
+
+            return {
+                worker_id: {
+                    "alive": worker["process"].is_alive(),
+                    "seconds_since_heartbeat": round(now - worker["last_heartbeat"], 1),
+                    "processed": worker["processed"],
+                    "queue_depth": worker["queue_depth"],
+                    "pending": len(worker["outstanding"])
+                }
+                for worker_id, worker in self.workers.items()
+            }
+
+    def _handle_status(self, kind, worker_id, payload):
+        if kind == "portfolio":
+            portfolio.apply_event(payload)
+            return
+
+        with self.lock:
+            worker = self.workers.get(worker_id)
+
+            if worker is None:
+                return
+
+            if kind == "heartbeat":
+                worker["last_heartbeat"] = time.monotonic()
+                worker["processed"] = payload["processed"]
+                worker["queue_depth"] = payload["queue_depth"]
+            elif kind == "done":
+                worker["outstanding"].pop(payload, None)
+
+    def _monitor(self):
+        last_health_log = time.monotonic()
+
+        while True:
+            try:
+                kind, worker_id, payload = self.status_queue.get(timeout=1)
+                self._handle_status(kind, worker_id, payload)
+            except Empty:
+                pass
+            except Exception as e:
+                logger.error(f"Error handling worker status: {e}")
+
+            now = time.monotonic()
+
+            for worker_id, health in self.get_health().items():
+                if not health["alive"] or health["seconds_since_heartbeat"] > HEARTBEAT_TIMEOUT:
+                    self._restart(worker_id)
+
+            if now - last_health_log > HEALTH_LOG_INTERVAL:
+                logger.info(f"Worker health: {self.get_health()}")
+                last_health_log = now
+
+    def stop(self):
+        with self.lock:
+            for worker in self.workers.values():
+                worker["queue"].put(None)
+
+
+def run_fleet(worker_count):
+    # The intake process is the only one polling Telegram; commands are forwarded to workers by customer
+    fleet = WorkerFleet(worker_count)
+    fleet.start()
+
+    # /QS is answered here, from the queue depths the workers report with their heartbeats
+    set_worker_queue_depths(lambda: {worker_id: health["queue_depth"] for worker_id, health in fleet.get_health().items()})
+
+    updater = setup_bot()
+
+    def route_update(update, context):
+        if update.message is None or not update.message.text:
+            return
+
+        command, _ = parse_routing_key(update)
+
+        if command in LOCAL_COMMANDS:
+            return
+
+        if fleet.route(update):
+            raise DispatcherHandlerStop()
+
+        logger.error("No worker processes are alive, handling the update in the intake process")
+
+    updater.dispatcher.add_handler(TypeHandler(Update, route_update), group=-1)
+
+    updater.start_polling()
+    updater.idle()
+    fleet.stop()
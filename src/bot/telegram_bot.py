@@ -1,15 +1,16 @@
 import os
 import re
 import math
+import hashlib
 from datetime import datetime
+from collections import OrderedDict
 from dotenv import load_dotenv
 from utils.custom_logger import get_custom_logger
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import CommandHandler, CallbackQueryHandler
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import CommandHandler, CallbackQueryHandler, InlineQueryHandler
 
 from utils.helper import (
     get_fx_daily_low,
-    get_existing_sheets, 
     update_sheet_values, 
     find_empty_row, 
     save_percent_to_file, 
@@ -17,13 +18,50 @@ from utils.helper import (
     take_screenshot,
     upload_to_sendgb,
     send_one_time_photo,
-    get_bot_service
+    get_bot_service,
+    get_sheet_values,
+    claim_record_row
 )
+from utils.sheets_scheduler import execute_request, get_queue_depth, get_worker_queue_depths
+from utils.sheet_directory import resolve_spreadsheet_id, place_sheet, register_sheet, get_spreadsheet_tabs
+from utils.ledger_journal import get_idempotency_key, begin_entry, run_step, run_with_retries, complete_entry, prune_journal, customer_lock
+from utils.reconciliation import reconcile_balances, get_ledger_totals, TOTAL_DUE_CELL, TOTAL_PAID_CELL, BALANCE_CELL
+from utils.send_queue import start_send_queue, queue_reply, queue_edit, queue_callback_answer, queue_inline_answer
+from utils.customer_index import load_customer_index, get_customer_page, search_customers
+from utils.portfolio import record_deposit, record_payment, get_portfolio_summary, rebuild_portfolio
 
 load_dotenv()
 logger = get_custom_logger(__name__)
 default_interest_percent = load_percent_from_file()
 
+LIST_PAGE_SIZE = 30  # Customers per /LS page
+INLINE_RESULTS_LIMIT = 20
+
+# /LS search queries are kept here and only their short ID goes into the 64-byte callback data
+LIST_QUERY_CACHE_SIZE = 1000
+list_queries = OrderedDict()
+
+def remember_list_query(query):
+    if not query:
+        return ""
+
+    query_id = hashlib.sha1(query.encode()).hexdigest()[:12]
+    list_queries[query_id] = query
+    list_queries.move_to_end(query_id)
+
+    while len(list_queries) > LIST_QUERY_CACHE_SIZE:
+        list_queries.popitem(last=False)
+
+    return query_id
+
+def refresh_default_percent():
+    # /CP may have been applied by another process, so ledger commands use the percent saved in the file
+    global default_interest_percent
+    percent = load_percent_from_file()
+
+    if percent is not None:
+        default_interest_percent = percent
+
 def setup_bot():
     logger.info("Bot is starting...")
     bot_service = get_bot_service()
@@ -31,8 +69,10 @@ def setup_bot():
     logger.info("Initializing modules...")
 
     dispatcher = updater.dispatcher
+    start_send_queue(updater.bot) # All replies go through the rate-limited send queue
     sheet_service = bot_service["sheet_service"]
-    existing_sheet_id = os.getenv("GOOGLE_SHEET_FILE_ID") # ID of the existing Google Sheet
+    prune_journal() # Drop old ledger journal entries
+    load_customer_index(sheet_service) # Index customer names for /LS and inline search
 
     def new_customer(update, context):
         # Implement logic to create a new Google Sheet for the customer
@@ -44,24 +84,36 @@ def setup_bot():
 
         if len(args) < 2:
             logger.error("Please provide Sheet name and Password in the correct format")
-            update.message.reply_text("Please provide Sheet name and Password in the correct format\n\n"
-                                      "Format: /NC [Sheet name] [Password]\n\n"
-                                      "Example: /NC Zangetsu Password123")
+            queue_reply(update, "Please provide Sheet name and Password in the correct format\n\n"
+                                "Format: /NC [Sheet name] [Password]\n\n"
+                                "Example: /NC Zangetsu Password123")
             return
 
         sheet_name = args[0].lower()
         customer_password = args[1]
 
         try:
-            existing_sheets = get_existing_sheets(existing_sheet_id, sheet_service)
+            journal_key = get_idempotency_key("NC", update)
+            entry = begin_entry(journal_key, "NC")
 
-            # Check if the sheet exists
-            if f"{sheet_name} GBP/EUR" in existing_sheets:
-                logger.error(f"Sheet '{sheet_name} GBP/EUR' already exists")
-                update.message.reply_text(f"Sheet '{sheet_name} GBP/EUR' already exists")
+            # A retried update that already completed becomes a no-op
+            if entry["status"] == "done":
+                logger.info(f"Command '{journal_key}' was already processed")
+                queue_reply(update, entry["reply"])
                 return
+
+            # Check if the sheet exists, unless this is a resumed command; its tab may have been added without
+            # the journal recording it, and add_sheet() already skips a tab that exists
+            if not entry["steps"]:
+                if resolve_spreadsheet_id(sheet_service, f"{sheet_name} GBP/EUR") is not None:
+                    logger.error(f"Sheet '{sheet_name} GBP/EUR' already exists")
+                    queue_reply(update, f"Sheet '{sheet_name} GBP/EUR' already exists")
+                    return
             
-            # Use the Google Sheets API to add a new sheet to the existing Google Sheet
+            # Place the customer in one of the spreadsheets, keeping the same choice on a retry
+            spreadsheet_id = run_step(journal_key, "placement", lambda: place_sheet(sheet_service, f"{sheet_name} GBP/EUR"))
+
+            # Use the Google Sheets API to add a new sheet to the chosen Google Sheet
             new_sheet_body = {
                 "requests": [
                     {
@@ -74,33 +126,47 @@ def setup_bot():
                 ]
             }
 
-            sheet_service.spreadsheets().batchUpdate(
-                spreadsheetId=existing_sheet_id,
-                body=new_sheet_body
-            ).execute()
+            def add_sheet():
+                # A timed out attempt may already have added the tab, so check before adding it again
+                if f"{sheet_name} GBP/EUR" in get_spreadsheet_tabs(sheet_service, spreadsheet_id):
+                    return {}
+
+                return execute_request(
+                    sheet_service.spreadsheets().batchUpdate(
+                        spreadsheetId=spreadsheet_id,
+                        body=new_sheet_body
+                    ),
+                    kind="write"
+                )
+
+            run_step(journal_key, "add_sheet", add_sheet)
+            register_sheet(f"{sheet_name} GBP/EUR", spreadsheet_id)
 
             # Add header row to the new sheet
             header_row = [["Date", "Description", "GBP Amount", "Jock Amount", "Exchange Rate", "Interest Percent", "EUR Amount", "EUR Paid"]]
             header_range = f"{sheet_name} GBP/EUR!A1:H1"
 
-            update_sheet_values(sheet_service, existing_sheet_id, header_range, header_row)
+            run_step(journal_key, "header_row", lambda: update_sheet_values(sheet_service, spreadsheet_id, header_range, header_row))
 
             initial_values = [["Total Due EUR"], ["Total Paid EUR"], ["Balance EUR"], ["Password"]]
             initial_range = f"{sheet_name} GBP/EUR!J1:J4"
 
-            update_sheet_values(sheet_service, existing_sheet_id, initial_range, initial_values)
+            run_step(journal_key, "initial_values", lambda: update_sheet_values(sheet_service, spreadsheet_id, initial_range, initial_values))
 
             new_values = [[0], [0], [0], [customer_password]]
             new_range = f"{sheet_name} GBP/EUR!K1:K4"
 
-            update_sheet_values(sheet_service, existing_sheet_id, new_range, new_values)
+            run_step(journal_key, "new_values", lambda: update_sheet_values(sheet_service, spreadsheet_id, new_range, new_values))
+
+            reply = f"New sheet '{sheet_name} GBP/EUR' created successfully for the customer"
+            complete_entry(journal_key, reply)
 
-            logger.info(f"New sheet '{sheet_name} GBP/EUR' created successfully for the customer")
-            update.message.reply_text(f"New sheet '{sheet_name} GBP/EUR' created successfully for the customer")
+            logger.info(reply)
+            queue_reply(update, reply)
         
         except Exception as e:
             logger.error(f"Error creating sheet: {str(e)}")
-            update.message.reply_text(f"Error creating sheet: {str(e)}")
+            queue_reply(update, f"Error creating sheet: {str(e)}")
 
 
     def payments_in(update, context):
@@ -109,8 +175,19 @@ def setup_bot():
         logger.info("Handling /payments_in command...")
 
         global default_interest_percent # Access the global variable
+        refresh_default_percent()
 
         try:
+            journal_key = get_idempotency_key("PI", update)
+            entry = begin_entry(journal_key, "PI")
+            resumed = bool(entry["steps"])
+
+            # A retried update that already completed becomes a no-op
+            if entry["status"] == "done":
+                logger.info(f"Command '{journal_key}' was already processed")
+                queue_reply(update, entry["reply"])
+                return
+
             command_text = update.message.text[len('/PI '):].strip()  # Remove command prefix and strip whitespace
         
             pattern = re.compile(
@@ -125,7 +202,7 @@ def setup_bot():
             
             if not match:
                 logger.error("Couldn't parse the command. Please check the format and try again")
-                update.message.reply_text("Couldn't parse the command. Please check the format and try again")
+                queue_reply(update, "Couldn't parse the command. Please check the format and try again")
                 return
 
             # Extracting the matched groups with default values for optional fields
@@ -137,7 +214,7 @@ def setup_bot():
 
             if jock_amount >= total_units:
                 logger.error("Jock amount can't be more than total units")
-                update.message.reply_text("Jock amount can't be more than total units")
+                queue_reply(update, "Jock amount can't be more than total units")
                 return
             
             gbp_amount1 = total_units - jock_amount if jock_amount_str else total_units
@@ -149,49 +226,72 @@ def setup_bot():
             date = datetime.strptime(date_str, "%d/%m/%Y").strftime("%d/%m/%Y") if date_str else datetime.now().strftime("%d/%m/%Y")
 
             logger.info(f"Extracted details below \nSheet Name: {sheet_name} \nReference: {reference} \nPayment Amount: {amount} \nJock Amount: {jock_amount} \nExchange Rate: {exchange_rate} \nInterest Percent: {percentage} \nDate: {date}")
-            existing_sheets = get_existing_sheets(existing_sheet_id, sheet_service)
+            spreadsheet_id = resolve_spreadsheet_id(sheet_service, f"{sheet_name} GBP/EUR")
 
             # Check if the sheet exists
-            if f"{sheet_name} GBP/EUR" not in existing_sheets:
+            if spreadsheet_id is None:
                 logger.error(f"Sheet '{sheet_name} GBP/EUR' does not exist")
-                update.message.reply_text(f"Sheet '{sheet_name} GBP/EUR' does not exist")
+                queue_reply(update, f"Sheet '{sheet_name} GBP/EUR' does not exist")
                 return
 
-            # Find the first empty row in the specified sheet
-            empty_row = find_empty_row(sheet_service, existing_sheet_id, sheet_name)
-            eur_amount = math.ceil((amount * (1 - percentage/100)) * exchange_rate)
+            # Other ledger commands and reconciliation repairs for this customer wait until its row and balance are written
+            with customer_lock(f"{sheet_name} GBP/EUR"):
+                # Find the first empty row in the specified sheet, reusing the journaled row on a retry
+                empty_row = run_step(journal_key, "empty_row", lambda: find_empty_row(sheet_service, spreadsheet_id, sheet_name))
+                eur_amount = math.ceil((amount * (1 - percentage/100)) * exchange_rate)
 
-            # Add a new record to the customer's sheet
-            record_values = [[date, reference, amount, jock_amount, exchange_rate, percentage, eur_amount, ""]]
-            record_range = f"{sheet_name} GBP/EUR!A{empty_row}:H{empty_row}"
+                # Journal the record so a retry writes the same values even if the exchange rate or date changed
+                record_values = run_step(journal_key, "record", lambda: [[date, reference, amount, jock_amount, exchange_rate, percentage, eur_amount, ""]])
+                eur_amount = record_values[0][6]
 
-            update_sheet_values(sheet_service, existing_sheet_id, record_range, record_values)
+                def write_record():
+                    row = claim_record_row(sheet_service, spreadsheet_id, sheet_name, record_values[0], empty_row)
+                    update_sheet_values(sheet_service, spreadsheet_id, f"{sheet_name} GBP/EUR!A{row}:H{row}", record_values)
+                    return row
 
-            # Get the current EUR balance from cell K3
-            eur_balance_range = f"{sheet_name} GBP/EUR!K3"
-            eur_balance_response = sheet_service.spreadsheets().values().get(
-                spreadsheetId=existing_sheet_id,
-                range=eur_balance_range
-            ).execute()
+                # Add a new record to the customer's sheet
+                record_row = run_step(journal_key, "write_record", write_record)
 
-            eur_balance = int(eur_balance_response.get('values', [[0]])[0][0])
-            new_eur_balance = eur_balance + eur_amount # Add the new EUR amount to the existing balance
+                # Get the current Total Due, Total Paid and EUR balance from cells K1:K3
+                totals_range = f"{sheet_name} GBP/EUR!K1:K3"
 
-            # Update the EUR balance in cell K3
-            update_sheet_values(sheet_service, existing_sheet_id, eur_balance_range, [[new_eur_balance]])
+                def get_new_totals():
+                    totals_response = get_sheet_values(sheet_service, spreadsheet_id, totals_range)
+                    totals = totals_response.get('values', [])
+                    total_due, total_paid, eur_balance = [int(totals[index][0]) if len(totals) > index and totals[index] else 0 for index in range(3)]
+                    return [total_due + eur_amount, total_paid, eur_balance + eur_amount] # Add the new EUR amount to the amount due and the balance
 
-            logger.info(f"Deposit record added successfully for '{sheet_name} GBP/EUR'. New balance is {new_eur_balance} EUR")
-            update.message.reply_text(f"Deposit record added successfully for '{sheet_name} GBP/EUR'. New balance is {new_eur_balance} EUR")
+                if resumed and "write_totals" not in entry["steps"]:
+                    # Other commands may have changed the totals since this one stopped, and its own write may or may not
+                    # have landed, so they are recomputed from the ledger rows instead of journaled values
+                    ledger_totals = run_with_retries(journal_key, "totals", lambda: get_ledger_totals(sheet_service, spreadsheet_id, f"{sheet_name} GBP/EUR"))
+                    new_totals = [ledger_totals[TOTAL_DUE_CELL], ledger_totals[TOTAL_PAID_CELL], ledger_totals[BALANCE_CELL]]
+                else:
+                    # The new totals are journaled as absolute values so a retry never adds the amount twice
+                    new_totals = run_step(journal_key, "totals", get_new_totals)
+
+                # Update cells K1:K3; K2 is written back unchanged, which is safe while the customer's lock is held
+                run_step(journal_key, "write_totals", lambda: update_sheet_values(sheet_service, spreadsheet_id, totals_range, [[total] for total in new_totals]))
+                new_eur_balance = new_totals[2]
+
+            # Keep the portfolio aggregates current, once per command even across retries
+            run_step(journal_key, "aggregates", lambda: record_deposit(sheet_name, record_values[0][0], record_values[0][2], record_values[0][5], record_values[0][6], record_row))
+
+            reply = f"Deposit record added successfully for '{sheet_name} GBP/EUR'. New balance is {new_eur_balance} EUR"
+            complete_entry(journal_key, reply)
+
+            logger.info(reply)
+            queue_reply(update, reply)
 
         except ValueError as e:
             logger.error(f"ValueError occurred: {str(e)}")
-            update.message.reply_text("Invalid input: please ensure numerical values are correct")
+            queue_reply(update, "Invalid input: please ensure numerical values are correct")
         except TypeError as e:
             logger.error(f"TypeError occurred: {str(e)}")
-            update.message.reply_text("Invalid operation: please check the format of your inputs")
+            queue_reply(update, "Invalid operation: please check the format of your inputs")
         except Exception as e:
             logger.error(f"Error processing deposit: {str(e)}")
-            update.message.reply_text(f"Error processing deposit: {str(e)}")
+            queue_reply(update, f"Error processing deposit: {str(e)}")
 
 
     def payments_out(update, context):
@@ -200,6 +300,7 @@ def setup_bot():
         logger.info("Handling /payments_out command...")
 
         global default_interest_percent
+        refresh_default_percent()
 
         command_text = update.message.text[len('/PO '):].strip()  # Adjust the slice to remove '/PO ' prefix correctly        
         pattern = re.compile(r'(\w+)\s*-\s*(.*?)\s+([\d,]+)\s*(EUR)\s*(\d{2}/\d{2}/\d{4})?')
@@ -207,9 +308,9 @@ def setup_bot():
         match = pattern.search(command_text)
         if not match:
             logger.error("Invalid format for payment details")
-            update.message.reply_text("Please provide a valid format for payment details\n\n"
-                                      "Format: /PO [Sheet name]-[Reference] [Amount][Currency] [dd/mm/yyyy]\n\n"
-                                      "Example: /PO Harry-First payment 500EUR 22/01/2024")
+            queue_reply(update, "Please provide a valid format for payment details\n\n"
+                                "Format: /PO [Sheet name]-[Reference] [Amount][Currency] [dd/mm/yyyy]\n\n"
+                                "Example: /PO Harry-First payment 500EUR 22/01/2024")
             return
 
         sheet_name, reference, amount_str, currency, date_str = match.groups()
@@ -217,74 +318,112 @@ def setup_bot():
         
         jock_amount = 0
         sheet_name = sheet_name.lower()
+
+        journal_key = get_idempotency_key("PO", update)
+        entry = begin_entry(journal_key, "PO")
+        resumed = bool(entry["steps"])
+
+        # A retried update that already completed becomes a no-op
+        if entry["status"] == "done":
+            logger.info(f"Command '{journal_key}' was already processed")
+            queue_reply(update, entry["reply"])
+            return
+
         exchange_rate = get_fx_daily_low("GBP", currency.upper())
         date = datetime.strptime(date_str, "%d/%m/%Y").strftime("%d/%m/%Y") if date_str else datetime.now().strftime("%d/%m/%Y")
 
         logger.info(f"Extracted details below \nSheet Name: {sheet_name} \nReference: {reference} \nPayment Amount: {eur_amount} \nCurrency: {currency.upper()} \nExchange Rate: {exchange_rate} \nInterest Percent: {default_interest_percent} \nDate: {date}")
         
         try:
-            existing_sheets = get_existing_sheets(existing_sheet_id, sheet_service)
+            spreadsheet_id = resolve_spreadsheet_id(sheet_service, f"{sheet_name} GBP/EUR")
 
             # Check if the sheet exists
-            if f"{sheet_name} GBP/EUR" not in existing_sheets:
+            if spreadsheet_id is None:
                 logger.error(f"Sheet '{sheet_name} GBP/EUR' does not exist")
-                update.message.reply_text(f"Sheet '{sheet_name} GBP/EUR' does not exist")
+                queue_reply(update, f"Sheet '{sheet_name} GBP/EUR' does not exist")
                 return
             
-            # Get the current EUR balance from cell K3
-            eur_balance_range = f"{sheet_name} GBP/EUR!K3"
-            eur_balance_response = sheet_service.spreadsheets().values().get(
-                spreadsheetId=existing_sheet_id,
-                range=eur_balance_range
-            ).execute()
-
-            eur_balance = int(eur_balance_response.get('values', [[0]])[0][0])
-
-            # Check if the payment amount exceeds the EUR balance
-            # if eur_amount > eur_balance:
-            #     logger.error(f"Error: Insufficient funds. The requested payment amount exceeds the available EUR balance")
-            #     update.message.reply_text(f"Error: Insufficient funds. The requested payment amount exceeds the available EUR balance")
-            #     return
+            # Other ledger commands and reconciliation repairs for this customer wait until its row and totals are written
+            with customer_lock(f"{sheet_name} GBP/EUR"):
+                # Get the current EUR balance from cell K3
+                eur_balance_range = f"{sheet_name} GBP/EUR!K3"
+
+                def get_eur_balance():
+                    eur_balance_response = get_sheet_values(sheet_service, spreadsheet_id, eur_balance_range)
+                    return int(eur_balance_response.get('values', [[0]])[0][0])
+
+                # Balances are journaled when first read so a retry never subtracts the amount twice
+                eur_balance = run_step(journal_key, "eur_balance", get_eur_balance)
+
+                # Check if the payment amount exceeds the EUR balance
+                # if eur_amount > eur_balance:
+                #     logger.error(f"Error: Insufficient funds. The requested payment amount exceeds the available EUR balance")
+                #     queue_reply(update, f"Error: Insufficient funds. The requested payment amount exceeds the available EUR balance")
+                #     return
             
-            # Find the first empty row in the specified sheet
-            empty_row = find_empty_row(sheet_service, existing_sheet_id, sheet_name)
-            gbp_amount = math.ceil((eur_amount/exchange_rate) / (1 - default_interest_percent/100))
+                # Find the first empty row in the specified sheet, reusing the journaled row on a retry
+                empty_row = run_step(journal_key, "empty_row", lambda: find_empty_row(sheet_service, spreadsheet_id, sheet_name))
+                gbp_amount = math.ceil((eur_amount/exchange_rate) / (1 - default_interest_percent/100))
+
+                # Journal the record so a retry writes the same values even if the exchange rate or date changed
+                record_values = run_step(journal_key, "record", lambda: [[date, reference, gbp_amount, jock_amount, exchange_rate, default_interest_percent, "", eur_amount]])
+
+                def write_record():
+                    row = claim_record_row(sheet_service, spreadsheet_id, sheet_name, record_values[0], empty_row)
+                    update_sheet_values(sheet_service, spreadsheet_id, f"{sheet_name} GBP/EUR!A{row}:H{row}", record_values)
+                    return row
 
-            # Add a new record to the customer's sheet
-            record_values = [[date, reference, gbp_amount, jock_amount, exchange_rate, default_interest_percent, "", eur_amount]]
-            record_range = f"{sheet_name} GBP/EUR!A{empty_row}:H{empty_row}"
+                # Add a new record to the customer's sheet
+                record_row = run_step(journal_key, "write_record", write_record)
 
-            update_sheet_values(sheet_service, existing_sheet_id, record_range, record_values)
+                # Other commands may have changed K2 and K3 since a resumed command stopped, and its own writes may or
+                # may not have landed, so unwritten totals are recomputed from the ledger rows instead of journaled values
+                ledger_totals = None
 
-            # Get the current Total Paid EUR from cell K2
-            total_paid_range = f"{sheet_name} GBP/EUR!K2"
-            total_paid_response = sheet_service.spreadsheets().values().get(
-                spreadsheetId=existing_sheet_id,
-                range=total_paid_range
-            ).execute()
+                if resumed and not {"write_total_paid_balance", "write_eur_balance"} <= set(entry["steps"]):
+                    ledger_totals = run_with_retries(journal_key, "ledger_totals", lambda: get_ledger_totals(sheet_service, spreadsheet_id, f"{sheet_name} GBP/EUR"))
 
-            total_paid_balance = int(total_paid_response.get('values', [[0]])[0][0])
-            new_total_paid_balance = total_paid_balance + eur_amount
+                # Get the current Total Paid EUR from cell K2
+                total_paid_range = f"{sheet_name} GBP/EUR!K2"
 
-            # Update the Total Paid EUR in cell K2
-            update_sheet_values(sheet_service, existing_sheet_id, total_paid_range, [[new_total_paid_balance]])
+                def get_new_total_paid_balance():
+                    total_paid_response = get_sheet_values(sheet_service, spreadsheet_id, total_paid_range)
+                    total_paid_balance = int(total_paid_response.get('values', [[0]])[0][0])
+                    return total_paid_balance + eur_amount
 
-            # Update the EUR balance in cell K3
-            new_eur_balance = eur_balance - eur_amount
-            update_sheet_values(sheet_service, existing_sheet_id, eur_balance_range, [[new_eur_balance]]) 
+                if ledger_totals is not None and "write_total_paid_balance" not in entry["steps"]:
+                    new_total_paid_balance = ledger_totals[TOTAL_PAID_CELL]
+                else:
+                    new_total_paid_balance = run_step(journal_key, "total_paid_balance", get_new_total_paid_balance)
 
-            logger.info(f"Payment record added successfully for '{sheet_name} GBP/EUR'. New balance is {new_eur_balance} EUR")
-            update.message.reply_text(f"Payment record added successfully for '{sheet_name} GBP/EUR'. New balance is {new_eur_balance} EUR")
+                # Update the Total Paid EUR in cell K2
+                run_step(journal_key, "write_total_paid_balance", lambda: update_sheet_values(sheet_service, spreadsheet_id, total_paid_range, [[new_total_paid_balance]]))
+
+                # Update the EUR balance in cell K3
+                if ledger_totals is not None and "write_eur_balance" not in entry["steps"]:
+                    new_eur_balance = ledger_totals[BALANCE_CELL]
+                else:
+                    new_eur_balance = eur_balance - eur_amount
+                run_step(journal_key, "write_eur_balance", lambda: update_sheet_values(sheet_service, spreadsheet_id, eur_balance_range, [[new_eur_balance]]))
+
+            # Keep the portfolio aggregates current, once per command even across retries
+            run_step(journal_key, "aggregates", lambda: record_payment(sheet_name, record_values[0][0], record_values[0][7], record_row))
+
+            reply = f"Payment record added successfully for '{sheet_name} GBP/EUR'. New balance is {new_eur_balance} EUR"
+            complete_entry(journal_key, reply)
+
+            logger.info(reply)
+            queue_reply(update, reply)
         
         except ValueError as e:
             logger.error(f"ValueError occurred: {str(e)}")
-            update.message.reply_text("Invalid input: please ensure numerical values are correct")
+            queue_reply(update, "Invalid input: please ensure numerical values are correct")
         except TypeError as e:
             logger.error(f"TypeError occurred: {str(e)}")
-            update.message.reply_text("Invalid operation: please check the format of your inputs")
+            queue_reply(update, "Invalid operation: please check the format of your inputs")
         except Exception as e:
             logger.error(f"Error processing deposit: {str(e)}")
-            update.message.reply_text(f"Error processing deposit: {str(e)}")
+            queue_reply(update, f"Error processing deposit: {str(e)}")
 
 
     def change_percent_assumptions(update, context):
@@ -297,9 +436,9 @@ def setup_bot():
 
         if len(args) < 1:
             logger.error("Invalid format for new percent assumption")
-            update.message.reply_text("Please provide a valid format for new percent assumption\n\n" 
-                                      "Format: /CP [Percent Amount]\n\n"
-                                      "Example: /CP 12.5")
+            queue_reply(update, "Please provide a valid format for new percent assumption\n\n" 
+                                "Format: /CP [Percent Amount]\n\n"
+                                "Example: /CP 12.5")
             return
 
         new_percent = args[0]
@@ -310,10 +449,10 @@ def setup_bot():
             save_percent_to_file(default_interest_percent) # Save the new interest percent to a file
 
             logger.info(f"Default interest percent changed to {default_interest_percent}%")
-            update.message.reply_text(f"Default interest percent changed to {default_interest_percent}%")
+            queue_reply(update, f"Default interest percent changed to {default_interest_percent}%")
         except ValueError:
             logger.error("Invalid percent amount. Please provide a valid number")
-            update.message.reply_text("Invalid percent amount. Please provide a valid number")
+            queue_reply(update, "Invalid percent amount. Please provide a valid number")
 
 
     def change_sheet_password(update, context):
@@ -327,32 +466,32 @@ def setup_bot():
         match = pattern.search(command_text)
         if not match:
             logger.error("Invalid format for new customer password")
-            update.message.reply_text("Please provide a valid format for new customer password\n\n"
-                                      "Ensure the password does not contain spaces\n\n"
-                                      "Format: /CSP [Customer]-[New Password]\n\n"
-                                      "Example: /CSP Harry-Imagine123")
+            queue_reply(update, "Please provide a valid format for new customer password\n\n"
+                                "Ensure the password does not contain spaces\n\n"
+                                "Format: /CSP [Customer]-[New Password]\n\n"
+                                "Example: /CSP Harry-Imagine123")
             return
 
         sheet_name, new_password = match.groups()
         sheet_name = sheet_name.lower()
 
         try:
-            existing_sheets = get_existing_sheets(existing_sheet_id, sheet_service)
+            spreadsheet_id = resolve_spreadsheet_id(sheet_service, f"{sheet_name} GBP/EUR")
 
             # Check if the sheet exists
-            if f"{sheet_name} GBP/EUR" not in existing_sheets:
+            if spreadsheet_id is None:
                 logger.error(f"Sheet '{sheet_name} GBP/EUR' does not exist")
-                update.message.reply_text(f"Sheet '{sheet_name} GBP/EUR' does not exist")
+                queue_reply(update, f"Sheet '{sheet_name} GBP/EUR' does not exist")
                 return
             
             password_range = f"{sheet_name} GBP/EUR!K4"
-            update_sheet_values(sheet_service, existing_sheet_id, password_range, [[new_password]]) # Update the password in cell K4
+            update_sheet_values(sheet_service, spreadsheet_id, password_range, [[new_password]]) # Update the password in cell K4
 
             logger.info(f"Password changed successfully for sheet '{sheet_name} GBP/EUR'")
-            update.message.reply_text(f"Password changed successfully for sheet '{sheet_name} GBP/EUR'")
+            queue_reply(update, f"Password changed successfully for sheet '{sheet_name} GBP/EUR'")
         except Exception as e:
             logger.error(f"Error changing password: {str(e)}")
-            update.message.reply_text(f"Error changing password: {str(e)}")
+            queue_reply(update, f"Error changing password: {str(e)}")
 
 
     def request_sheet(update, context):
@@ -364,65 +503,180 @@ def setup_bot():
 
         if len(args) == 0:
             logger.error("Invalid format for requesting sheet")
-            update.message.reply_text("Please provide a valid format for requesting sheet\n\n"
-                                      "Format: /RS [Sheet name]\n\n"
-                                      "Example: /RS Harry")
+            queue_reply(update, "Please provide a valid format for requesting sheet\n\n"
+                                "Format: /RS [Sheet name]\n\n"
+                                "Example: /RS Harry")
             return
 
         sheet_name = args[0].lower()
         sheet_title = f"{sheet_name} GBP/EUR"
 
         try:
-            existing_sheets = get_existing_sheets(existing_sheet_id, sheet_service)
+            spreadsheet_id = resolve_spreadsheet_id(sheet_service, sheet_title)
 
             # Check if the sheet exists
-            if sheet_title not in existing_sheets:
+            if spreadsheet_id is None:
                 logger.error(f"Sheet '{sheet_title}' does not exist")
-                update.message.reply_text(f"Sheet '{sheet_title}' does not exist")
+                queue_reply(update, f"Sheet '{sheet_title}' does not exist")
                 return
 
             # Take a screenshot of the customer's sheet
-            screenshot_filename = take_screenshot(sheet_title)
+            screenshot_bytes = take_screenshot(sheet_title, spreadsheet_id)
 
             password_range = f"{sheet_name} GBP/EUR!K4"
-            password_response = sheet_service.spreadsheets().values().get(
-                spreadsheetId=existing_sheet_id,
-                range=password_range
-            ).execute()
+            password_response = get_sheet_values(sheet_service, spreadsheet_id, password_range)
 
             customer_password = password_response.get('values', [[0]])[0][0]
 
             # Upload the customer's sheet to SendGB and get a link
-            sendgb_link = upload_to_sendgb(sheet_title, customer_password)
+            sendgb_link = upload_to_sendgb(sheet_title, customer_password, spreadsheet_id)
 
             # Generate a one-time photo of the customer's sheet and send it
-            send_one_time_photo(update, context, screenshot_filename, sheet_name)
+            send_one_time_photo(update, context, screenshot_bytes, sheet_name)
 
             # Send the SendGB link, customer's name, and one-time photo
             response_message = f"Request sheet Response:\n- SendGB link: {sendgb_link}\n- Customer's name: {sheet_name}"
 
             logger.info(response_message)
-            update.message.reply_text(response_message)
+            queue_reply(update, response_message)
         except Exception as e:
             logger.error(f"Error requesting sheet information: {str(e)}")
-            update.message.reply_text(f"Error requesting sheet information: {str(e)}")
+            queue_reply(update, f"Error requesting sheet information: {str(e)}")
+
+
+    def render_customer_page(page, query=""):
+        # Build the text and navigation keyboard for one page of customers
+        customers, total = get_customer_page(page, LIST_PAGE_SIZE, query)
+        page_count = max(1, math.ceil(total / LIST_PAGE_SIZE))
+
+        if total == 0:
+            return f"No sheets found{f' matching {query}' if query else ''}", None
+
+        heading = f"Sheets{f' matching {query}' if query else ''} (page {page + 1}/{page_count}, {total} total):"
+        text = heading + "\n" + "\n".join(f"- {customer}" for customer in customers)
+
+        query_id = remember_list_query(query)
+
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("« Prev", callback_data=f"ls_page:{page - 1}:{query_id}"))
+        if page + 1 < page_count:
+            navigation.append(InlineKeyboardButton("Next »", callback_data=f"ls_page:{page + 1}:{query_id}"))
+
+        return text, InlineKeyboardMarkup([navigation]) if navigation else None
 
 
     def list_sheet(update, context):
-        # Implement logic for listing all customer's sheets
+        # Implement logic for listing all customer's sheets from the in-memory index
         logger.info("User sent command: /LS")
         logger.info("Handling /list_sheet command...")
 
         try:
-            existing_sheets = get_existing_sheets(existing_sheet_id, sheet_service)
-            formatted_sheets = [sheet.replace(' GBP/EUR', '') for sheet in existing_sheets]
-            sheets_str = ', '.join(formatted_sheets)
+            query = " ".join(context.args).lower()
+            text, reply_markup = render_customer_page(0, query)
 
-            logger.info(f"These are all the available sheets: {sheets_str}")
-            update.callback_query.message.reply_text(f"These are all the available sheets: {sheets_str}")
+            queue_reply(update, text, reply_markup=reply_markup)
         except Exception as e:
             logger.error(f"Error listing sheets: {str(e)}")
-            update.callback_query.message.reply_text(f"Error listing sheets: {str(e)}")
+            queue_reply(update, f"Error listing sheets: {str(e)}")
+
+
+    def inline_search(update, context):
+        # Type-ahead search of customer names; choosing a result sends /RS for that customer
+        query = update.inline_query.query
+
+        results = [
+            InlineQueryResultArticle(
+                id=customer,
+                title=customer,
+                description=f"Request {customer}'s sheet",
+                input_message_content=InputTextMessageContent(f"/RS {customer}")
+            )
+            for customer in search_customers(query, limit=INLINE_RESULTS_LIMIT)
+        ]
+
+        queue_inline_answer(update.inline_query, results, cache_time=5, is_personal=True)
+
+
+    def reconcile_sheets(update, context):
+        # Implement logic for checking running totals against the ledger rows of every sheet
+        logger.info(f"User sent command: {update.message.text}")
+        logger.info("Handling /reconcile command...")
+
+        repair = len(context.args) > 0 and context.args[0].lower() == "fix"
+
+        try:
+            drifts = reconcile_balances(sheet_service, repair=repair)
+
+            if not drifts:
+                queue_reply(update, "All sheet balances match their ledger rows")
+                return
+
+            drift_lines = [f"- {drift['sheet']} {drift['cell']}: {drift['recorded']} should be {drift['expected']}" for drift in drifts[:20]]
+            more_str = f"\n...and {len(drifts) - 20} more" if len(drifts) > 20 else ""
+            action_str = "Repaired" if repair else "Found"
+
+            queue_reply(update, f"{action_str} {len(drifts)} drifted totals:\n" + "\n".join(drift_lines) + more_str)
+        except Exception as e:
+            logger.error(f"Error reconciling sheets: {str(e)}")
+            queue_reply(update, f"Error reconciling sheets: {str(e)}")
+
+
+    def portfolio_summary(update, context):
+        # Implement logic for reporting totals across all customers
+        logger.info(f"User sent command: {update.message.text}")
+        logger.info("Handling /summary command...")
+
+        try:
+            if len(context.args) > 0 and context.args[0].lower() == "rebuild":
+                rebuild_portfolio(sheet_service)
+
+            summary = get_portfolio_summary()
+            debtors_str = "\n".join(f"{index}. {customer}: {balance} EUR" for index, (customer, balance) in enumerate(summary["top_debtors"], start=1))
+
+            response_message = (f"Portfolio summary:\n"
+                                f"- Customers: {summary['customers']}\n"
+                                f"- Total deposits: {summary['deposits_eur']} EUR\n"
+                                f"- Total paid: {summary['paid_eur']} EUR\n"
+                                f"- Outstanding balance: {summary['outstanding_eur']} EUR\n"
+                                f"- Effective interest: {summary['effective_percent']:.2f}%\n"
+                                f"- Deposits today: {summary['today_deposits_eur']} EUR ({summary['today_deposits']} deposits)\n\n"
+                                f"Top debtors:\n{debtors_str or 'None'}")
+
+            logger.info(response_message)
+            queue_reply(update, response_message)
+        except Exception as e:
+            logger.error(f"Error building portfolio summary: {str(e)}")
+            queue_reply(update, f"Error building portfolio summary: {str(e)}")
+
+
+    def queue_status(update, context):
+        # Implement logic for reporting how many Google Sheets requests are waiting
+        logger.info(f"User sent command: {update.message.text}")
+        logger.info("Handling /queue_status command...")
+
+        # In a fleet, the totals add up this process's queue and the depths the workers last reported
+        process_depths = {"intake": get_queue_depth()}
+        process_depths.update({f"worker {worker_id}": worker_depth for worker_id, worker_depth in get_worker_queue_depths().items() if worker_depth})
+        depth = {name: sum(process_depth[name] for process_depth in process_depths.values()) for name in ("user", "background", "total")}
+
+        response_message = (f"Google Sheets queue:\n"
+                            f"- User commands waiting: {depth['user']}\n"
+                            f"- Background work waiting: {depth['background']}\n"
+                            f"- Total: {depth['total']}")
+
+        if len(process_depths) > 1:
+            response_message += "\n\nBy process:\n" + "\n".join(f"- {name}: {process_depth['total']}" for name, process_depth in process_depths.items())
+
+        logger.info(response_message)
+        queue_reply(update, response_message)
+
+
+    def scheduled_reconciliation(context):
+        try:
+            reconcile_balances(sheet_service, repair=os.getenv("RECONCILE_REPAIR", "false").lower() == "true")
+        except Exception as e:
+            logger.error(f"Error during scheduled reconciliation: {str(e)}")
 
 
     def error_handler(update, context):
@@ -430,36 +684,48 @@ def setup_bot():
         
         # Check if the error occurred during a callback query handling
         if update.callback_query:
-            update.callback_query.message.reply_text("An unexpected error occurred. Please try again")
+            queue_reply(update, "An unexpected error occurred. Please try again")
 
         elif update.message:
-            update.message.reply_text("An unexpected error occurred. Please try again")
+            queue_reply(update, "An unexpected error occurred. Please try again")
         else:
             logger.error("The error handler was called but no message or callback query was available to reply to")
 
 
     def button(update, context):
         query = update.callback_query
-        query.answer()
+        queue_callback_answer(query)
 
         # Send a message with instructions
         if query.data == "new_customer":
-            query.edit_message_text(text="Please provide Sheet name and Password\n\nFormat: /NC [Sheet name] [Password]\n\nExample: /NC Zangetsu Password123")
+            queue_edit(query, "Please provide Sheet name and Password\n\nFormat: /NC [Sheet name] [Password]\n\nExample: /NC Zangetsu Password123")
             return
         elif query.data == "payments_in":
-            query.edit_message_text(text="Please provide payment details\n\nFormat: /PI [Sheet name]-[Reference] [Amount][GBP] [Amount][Jock] @[Rate] @[Percent] [dd/mm/yyyy]\n\nExample: /PI Harry-First deposit 1000GBP 200J @1.1203 @7.0 17/01/2024")
+            queue_edit(query, "Please provide payment details\n\nFormat: /PI [Sheet name]-[Reference] [Amount][GBP] [Amount][Jock] @[Rate] @[Percent] [dd/mm/yyyy]\n\nExample: /PI Harry-First deposit 1000GBP 200J @1.1203 @7.0 17/01/2024")
             return
         elif query.data == "payments_out":
-            query.edit_message_text(text="Please provide payment details\n\nFormat: /PO [Sheet name]-[Reference] [Amount][Currency] [dd/mm/yyyy]\n\nExample: /PO Harry-First payment 500EUR 22/01/2024")
+            queue_edit(query, "Please provide payment details\n\nFormat: /PO [Sheet name]-[Reference] [Amount][Currency] [dd/mm/yyyy]\n\nExample: /PO Harry-First payment 500EUR 22/01/2024")
             return
         elif query.data == "change_percent":
-            query.edit_message_text(text="Please provide new percent assumption\n\nFormat: /CP [Percent Amount]\n\nExample: /CP 12.5")
+            queue_edit(query, "Please provide new percent assumption\n\nFormat: /CP [Percent Amount]\n\nExample: /CP 12.5")
             return
         elif query.data == "change_sheet_password":
-            query.edit_message_text(text="Please provide new customer password\n\nFormat: /CSP [Customer]-[New Password]\n\nExample: /CSP Harry-Imagine123")
+            queue_edit(query, "Please provide new customer password\n\nFormat: /CSP [Customer]-[New Password]\n\nExample: /CSP Harry-Imagine123")
             return
         elif query.data == "request_sheet":
-            query.edit_message_text(text="Please provide a Sheet name\n\nFormat: /RS [Sheet name]\n\nExample: /RS Harry")
+            queue_edit(query, "Please provide a Sheet name\n\nFormat: /RS [Sheet name]\n\nExample: /RS Harry")
+            return
+        elif query.data.startswith("ls_page:"):
+            _, page, query_id = query.data.split(":", 2)
+
+            # Queries are forgotten on restart or once enough newer searches were made
+            if query_id and query_id not in list_queries:
+                queue_edit(query, "This search has expired, please send /LS again")
+                return
+
+            text, reply_markup = render_customer_page(int(page), list_queries.get(query_id, ""))
+
+            queue_edit(query, text, reply_markup=reply_markup)
             return
         elif query.data == "list_sheet":
             context.args = []
@@ -477,9 +743,18 @@ def setup_bot():
     dispatcher.add_handler(CommandHandler("CSP", change_sheet_password))
     dispatcher.add_handler(CommandHandler("RS", request_sheet))
     dispatcher.add_handler(CommandHandler("LS", list_sheet))
+    # Full scans run on the dispatcher's thread pool, so they never hold up the updates behind them
+    dispatcher.add_handler(CommandHandler("RC", reconcile_sheets, run_async=True))
+    dispatcher.add_handler(CommandHandler("summary", portfolio_summary, run_async=True))
+    dispatcher.add_handler(CommandHandler("QS", queue_status))
+    dispatcher.add_handler(InlineQueryHandler(inline_search))
 
     dispatcher.add_error_handler(error_handler)
 
+    # Periodically check every sheet's running totals against its ledger rows
+    reconcile_interval = int(os.getenv("RECONCILE_INTERVAL_MINUTES", "60")) * 60
+    updater.job_queue.run_repeating(scheduled_reconciliation, interval=reconcile_interval, first=reconcile_interval)
+
     logger.info("Bot is now running and polling for updates...")
     return updater
 
@@ -496,4 +771,4 @@ def start(update, context):
         ]
 
         reply_markup = InlineKeyboardMarkup(keyboard)
-        update.message.reply_text('Please choose an option:', reply_markup=reply_markup)
\ No newline at end of file
+        queue_reply(update, 'Please choose an option:', reply_markup=reply_markup)
\ No newline at end of file
@@ -1,6 +1,14 @@
+import os
+from bot.fleet import run_fleet
 from bot.telegram_bot import setup_bot
 
 if __name__ == "__main__":
-    bot = setup_bot()
-    bot.start_polling()
-    bot.idle()
\ No newline at end of file
+    worker_processes = int(os.getenv("WORKER_PROCESSES", "0"))
+
+    # With worker processes, this process only takes in updates and hands commands to the workers
+    if worker_processes > 0:
+        run_fleet(worker_processes)
+    else:
+        bot = setup_bot()
+        bot.start_polling()
+        bot.idle()
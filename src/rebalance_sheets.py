@@ -0,0 +1,7 @@
+from utils.helper import get_bot_service
+from utils.sheet_directory import rebalance_sheets
+
+# Run with the bot stopped: moves customer tabs so every spreadsheet holds a similar number
+if __name__ == "__main__":
+    bot_service = get_bot_service()
+    rebalance_sheets(bot_service["sheet_service"])
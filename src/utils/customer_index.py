@@ -0,0 +1,119 @@
+import difflib
+import itertools
+import threading
+from collections import defaultdict
+from sortedcontainers import SortedList
+from utils.custom_logger import get_custom_logger
+from utils.sheet_directory import get_directory, refresh_directory, add_directory_listener, CUSTOMER_SHEET_SUFFIX
+
+logger = get_custom_logger(__name__)
+
+FUZZY_CUTOFF = 0.6  # Minimum similarity for a fuzzy match
+
+
+def _trigrams(name):
+    padded = f"  {name} "
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+class CustomerIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = SortedList()
+        self.trigram_index = defaultdict(set)  # Trigram -> names containing it, to find fuzzy candidates quickly
+
+    def add(self, name):
+        with self.lock:
+            if name in self.names:
+                return
+
+            self.names.add(name)
+
+            for trigram in _trigrams(name):
+                self.trigram_index[trigram].add(name)
+
+    def reset(self, names):
+        with self.lock:
+            self.names = SortedList(set(names))
+            self.trigram_index = defaultdict(set)
+
+            for name in self.names:
+                for trigram in _trigrams(name):
+                    self.trigram_index[trigram].add(name)
+
+    def count(self):
+        with self.lock:
+            return len(self.names)
+
+    def page(self, start, size):
+        with self.lock:
+            return list(self.names[start:start + size])
+
+    def search(self, query, limit):
+        # Prefix matches first, in alphabetical order, then the closest fuzzy matches
+        query = query.lower().strip()
+
+        with self.lock:
+            if not query:
+                return list(self.names[:limit])
+
+            results = list(itertools.islice(self.names.irange(query, f"{query}\uffff"), limit))
+
+            if len(results) < limit:
+                # Only names sharing trigrams with the query are scored
+                shared = defaultdict(int)
+
+                for trigram in _trigrams(query):
+                    for name in self.trigram_index.get(trigram, ()):
+                        shared[name] += 1
+
+                candidates = sorted(shared, key=shared.get, reverse=True)[:limit * 10]
+                scored = [(difflib.SequenceMatcher(None, query, name).ratio(), name) for name in candidates if name not in results]
+                fuzzy = [name for score, name in sorted(scored, reverse=True) if score >= FUZZY_CUTOFF]
+
+                results.extend(fuzzy[:limit - len(results)])
+
+            return results
+
+
+customer_index = CustomerIndex()
+
+
+def _customer_name(sheet_title):
+    return sheet_title[:-len(CUSTOMER_SHEET_SUFFIX)]
+
+
+def sync_customer_index(sheet_title=None):
+    # Add a single new customer, or reindex everything when the whole directory changed
+    if sheet_title is not None:
+        if sheet_title.endswith(CUSTOMER_SHEET_SUFFIX):
+            customer_index.add(_customer_name(sheet_title))
+        return
+
+    customer_index.reset(_customer_name(title) for title in get_directory() if title.endswith(CUSTOMER_SHEET_SUFFIX))
+    logger.info(f"Customer index rebuilt with {customer_index.count()} customers")
+
+
+def load_customer_index(sheet_service):
+    # Build the directory from Sheets if it has never been built, then index it
+    get_directory(sheet_service)
+    sync_customer_index()
+
+
+def search_customers(query, limit=20):
+    refresh_directory()
+    return customer_index.search(query, limit)
+
+
+def get_customer_page(page, page_size, query=""):
+    # Return the customers on one page (zero-based) and the total number of customers matching the query
+    refresh_directory()
+
+    if query:
+        matches = customer_index.search(query, limit=customer_index.count())
+        return matches[page * page_size:(page + 1) * page_size], len(matches)
+
+    return customer_index.page(page * page_size, page_size), customer_index.count()
+
+
+add_directory_listener(sync_customer_index)
@@ -0,0 +1,26 @@
+import os
+import json
+import fcntl
+from contextlib import contextmanager
+
+
+@contextmanager
+def locked_file(path):
+    # Hold an exclusive lock on a sidecar lock file, so processes of the fleet never interleave a read-modify-write
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_json_atomic(path, data):
+    # Every process writes its own temporary file, then renames it over the target in one step
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(tmp_path, "w") as file:
+        json.dump(data, file)
+
+    os.replace(tmp_path, path)
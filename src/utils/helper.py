@@ -1,4 +1,5 @@
 import os
+import httplib2
 import requests
 from dotenv import load_dotenv
 from selenium import webdriver
@@ -6,8 +7,12 @@ from telegram.utils.request import Request
 from selenium.webdriver.common.by import By
 from googleapiclient.discovery import build
 from utils.custom_logger import get_custom_logger
+from utils.sheets_scheduler import execute_request, set_http_factory, PRIORITY_USER
+from utils.send_queue import queue_photos, queue_reply
+from utils.image_pipeline import optimize_screenshot
+from utils.sheet_directory import resolve_spreadsheet_id, get_spreadsheet_url, get_spreadsheet_tabs
 from telegram.ext import Updater, CallbackContext
-from telegram import Bot, Update, InputMediaPhoto
+from telegram import Bot, Update
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.support import expected_conditions as EC
@@ -53,28 +58,20 @@ def get_bot_service():
         use_context=True
     )
     
-    sheet_service = build('sheets', 'v4', credentials=creds) 
+    sheet_service = build('sheets', 'v4', credentials=creds)
+    set_http_factory(lambda: creds.authorize(httplib2.Http())) # One Http per scheduler worker thread
     return { 'sheet_service': sheet_service, 'updater': updater, 'creds': creds }
 
 
-# Function to take a screenshot of the customer's sheet and save it
-def take_screenshot(sheet_name):
-    # Define the base filename
-    base_filename = f"{sheet_name.split(' ')[0]}_screenshot.png"
+# Function to take a screenshot of the customer's sheet and return it as optimized image bytes
+def take_screenshot(sheet_name, spreadsheet_id=None):
+    screenshot_bytes = None
 
-    # Define the path for the screenshots directory
-    screenshots_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "screenshots"))
-
-    # Create the screenshots directory if it doesn't exist
-    if not os.path.exists(screenshots_dir):
-        os.makedirs(screenshots_dir)
-
-    # Define the full path to save the screenshot
-    screenshot_filename = os.path.join(screenshots_dir, base_filename)
-    
     try:
         driver = webdriver.Chrome(options=chrome_options)
-        spreadsheet_url = os.getenv("GOOGLE_SHEET_URL")        
+        # Open the spreadsheet that holds the customer's tab
+        spreadsheet_id = spreadsheet_id or resolve_spreadsheet_id(None, sheet_name)
+        spreadsheet_url = get_spreadsheet_url(spreadsheet_id) if spreadsheet_id else os.getenv("GOOGLE_SHEET_URL")
         driver.get(spreadsheet_url)
 
         sheet_element = WebDriverWait(driver, 15).until(
@@ -90,58 +87,53 @@ def take_screenshot(sheet_name):
         # Wait for the UI to update after hiding the tab bar
         WebDriverWait(driver, 2).until(lambda d: d.execute_script(
             "return document.readyState") == "complete")
-        
-        driver.save_screenshot(screenshot_filename) # Take a screenshot of the sheet
+
+        # Find the cell grid on screen so the toolbar and menus can be cropped away
+        grid_box = driver.execute_script("""
+            const grid = document.querySelector('#waffle-grid-container');
+            if (!grid) return null;
+            const rect = grid.getBoundingClientRect();
+            const ratio = window.devicePixelRatio;
+            return [rect.left * ratio, rect.top * ratio, rect.right * ratio, rect.bottom * ratio].map(Math.round);
+        """)
+
+        # Take a screenshot of the sheet in memory and shrink it for upload
+        screenshot_bytes = optimize_screenshot(driver.get_screenshot_as_png(), grid_box)
     except Exception as e:
         logger.error(f"Screenshot error occurred with selenium driver: {e}")
     finally:
         driver.close()
 
-    return screenshot_filename
-
+    return screenshot_bytes
 
-def send_one_time_photo(update: Update, context: CallbackContext, filename: str, sheet_name: str):
-    # Use the context to get the bot object
-    bot = context.bot
 
+def send_one_time_photo(update: Update, context: CallbackContext, photo_bytes: bytes, sheet_name: str):
     # Use the message attribute of the update object to get the chat_id
     chat_id = update.message.chat_id
 
-    # Send the one-time photo
-    with open(filename, 'rb') as photo:
-        media = InputMediaPhoto(media=photo.read(), caption=f"Photo of {sheet_name}'s sheet")
-        bot.send_media_group(chat_id=chat_id, media=[media])
+    if photo_bytes is None:
+        logger.error(f"No screenshot available for {sheet_name}'s sheet")
+        queue_reply(update, f"Could not take a screenshot of {sheet_name}'s sheet, please try again")
+        return
 
-    # Delete the file after sending
-    try:
-        os.remove(filename)
-        logger.info(f"File {filename} deleted successfully")
-    except Exception as e:
-        logger.error(f"Error deleting file {filename}: {e}")
+    # Queue the one-time photo
+    queue_photos(chat_id, [(photo_bytes, f"Photo of {sheet_name}'s sheet")])
     
 
-def get_sheet_id(sheet_service, sheet_name):
-    result = sheet_service.spreadsheets().get(spreadsheetId=os.getenv("GOOGLE_SHEET_FILE_ID")).execute()
-    sheets = result.get('sheets', [])
-
+def get_sheet_id(sheet_service, sheet_name, spreadsheet_id):
     #* Find the sheet with the given name
-    sheet = next((s for s in sheets if s['properties']['title'] == sheet_name), None)
-
-    if sheet:
-        return sheet['properties']['sheetId']
-    else:
-        return None
+    return get_spreadsheet_tabs(sheet_service, spreadsheet_id).get(sheet_name)
     
 
-def download_pdf_sheet(sheet_name):
+def download_pdf_sheet(sheet_name, spreadsheet_id=None):
     try:
         bot_service = get_bot_service()
 
         creds = bot_service["creds"]
         sheet_service = bot_service["sheet_service"]
 
-        existing_sheet_id = os.getenv("GOOGLE_SHEET_FILE_ID") 
-        sheet_id = get_sheet_id(sheet_service, sheet_name)
+        existing_sheet_id = spreadsheet_id or resolve_spreadsheet_id(sheet_service, sheet_name)
+        sheet_id = get_sheet_id(sheet_service, sheet_name, existing_sheet_id) if existing_sheet_id else None
 
         if sheet_id is None:
             print(f"Sheet '{sheet_name}' not found.")
@@ -168,8 +160,8 @@ def download_pdf_sheet(sheet_name):
         logger.error(f"Error downloading sheet: {str(e)}")
 
 
-def upload_to_sendgb(sheet_name, customer_password):
-    pdf_file_path = download_pdf_sheet(sheet_name)
+def upload_to_sendgb(sheet_name, customer_password, spreadsheet_id=None):
+    pdf_file_path = download_pdf_sheet(sheet_name, spreadsheet_id)
 
     try:
         driver = webdriver.Chrome(options=chrome_options)
@@ -230,10 +222,14 @@ def upload_to_sendgb(sheet_name, customer_password):
 
 
 def save_percent_to_file(percent):
-    # Save the interest percent to the file
-    with open(percent_file_path, "w") as file:
+    # Save the interest percent to the file; the rename means other processes never read a half-written file
+    tmp_path = f"{percent_file_path}.{os.getpid()}.tmp"
+
+    with open(tmp_path, "w") as file:
         file.write(str(percent))
 
+    os.replace(tmp_path, percent_file_path)
+
 
 def load_percent_from_file():
     # Load the interest percent from the file
@@ -269,26 +265,17 @@ def get_fx_daily_low(base_currency, target_currency):
         logger.error("Error retrieving data. Check your API key and quota.")
 
 
-def get_existing_sheets(spreadsheet_id, sheets_service):
-    try:
-        # Use the Google Sheets API to get information about the spreadsheet
-        spreadsheet_info = sheets_service.spreadsheets().get(
-            spreadsheetId=spreadsheet_id
-        ).execute()
-
-        # Extract sheet names
-        sheet_names = [sheet['properties']['title'] for sheet in spreadsheet_info['sheets']]
-        return sheet_names
-
-    except Exception as e:
-        logger.error(f"Error getting existing sheets: {str(e)}")
-        return []
+def get_sheet_values(service, spreadsheet_id, range, priority=PRIORITY_USER):
+    return execute_request(
+        service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range),
+        priority=priority
+    )
 
 
-def find_empty_row(sheet_service, spreadsheet_id, sheet_name):
+def find_empty_row(sheet_service, spreadsheet_id, sheet_name, priority=PRIORITY_USER):
     # Find the first empty row in the specified sheet
     values_range = f"{sheet_name} GBP/EUR!A:H"
-    result = sheet_service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=values_range).execute()
+    result = get_sheet_values(sheet_service, spreadsheet_id, values_range, priority)
     values = result.get('values', [])
 
     if not values:
@@ -297,12 +284,38 @@ def find_empty_row(sheet_service, spreadsheet_id, sheet_name):
         return len(values) + 1
 
 
-def update_sheet_values(service, spreadsheet_id, range, values):
-    service.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range=range,
-        valueInputOption="RAW",
-        body={
-            "values": values
-        }
-    ).execute()
\ No newline at end of file
+def claim_record_row(sheet_service, spreadsheet_id, sheet_name, record, row, priority=PRIORITY_USER):
+    # Keep a journaled row only while it is empty or already holds this record; another command may have
+    # filled it since, in which case the record goes to the first empty row instead
+    result = execute_request(
+        sheet_service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id,
+            range=f"{sheet_name} GBP/EUR!A{row}:H{row}",
+            valueRenderOption="UNFORMATTED_VALUE"
+        ),
+        priority=priority
+    )
+    existing = (result.get('values') or [[]])[0]
+
+    if not existing or existing + [""] * (len(record) - len(existing)) == record:
+        return row
+
+    new_row = find_empty_row(sheet_service, spreadsheet_id, sheet_name, priority)
+    logger.info(f"Row {row} of '{sheet_name} GBP/EUR' was filled by another command, writing to row {new_row} instead")
+
+    return new_row
+
+
+def update_sheet_values(service, spreadsheet_id, range, values, priority=PRIORITY_USER):
+    return execute_request(
+        service.spreadsheets().values().update(
+            spreadsheetId=spreadsheet_id,
+            range=range,
+            valueInputOption="RAW",
+            body={
+                "values": values
+            }
+        ),
+        kind="write",
+        priority=priority
+    )
\ No newline at end of file
@@ -0,0 +1,71 @@
+from io import BytesIO
+from PIL import Image, ImageOps
+from utils.custom_logger import get_custom_logger
+
+logger = get_custom_logger(__name__)
+
+# Telegram displays photos in a chat at about 800px wide, so wider screenshots are scaled down to that width
+MAX_PHOTO_WIDTH = 800
+PHOTO_SIZE_BUDGET = 150 * 1024  # Bytes
+
+# Row and column headers stay in the image but are ignored when finding the used cell range
+HEADER_HEIGHT = 25
+HEADER_WIDTH = 46
+CONTENT_MARGIN = 12
+
+# Gridlines and cell backgrounds are lighter than this; cell text is darker
+CONTENT_THRESHOLD = 200
+
+JPEG_QUALITIES = [85, 75, 65, 50]
+
+
+def crop_to_used_range(image, grid_box=None):
+    # Crop to the grid, then cut off the empty rows and columns to the right of and below the last filled cell
+    if grid_box:
+        image = image.crop(grid_box)
+
+    grayscale = ImageOps.grayscale(image)
+    content = grayscale.crop((HEADER_WIDTH, HEADER_HEIGHT, grayscale.width, grayscale.height))
+    content_box = content.point(lambda pixel: 255 if pixel < CONTENT_THRESHOLD else 0).getbbox()
+
+    if content_box is None:
+        return image
+
+    right = min(image.width, HEADER_WIDTH + content_box[2] + CONTENT_MARGIN)
+    bottom = min(image.height, HEADER_HEIGHT + content_box[3] + CONTENT_MARGIN)
+
+    return image.crop((0, 0, right, bottom))
+
+
+def _encode(image, image_format, **options):
+    buffer = BytesIO()
+    image.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+def encode_within_budget(image, budget=PHOTO_SIZE_BUDGET):
+    # A palette PNG keeps sheet text sharp and is usually smallest; fall back to JPEG when it is over budget
+    candidates = [_encode(image.quantize(colors=256), "PNG", optimize=True)]
+
+    if len(candidates[0]) > budget:
+        for quality in JPEG_QUALITIES:
+            candidates.append(_encode(image, "JPEG", quality=quality, optimize=True))
+
+            if len(candidates[-1]) <= budget:
+                break
+
+    return min(candidates, key=len)
+
+
+def optimize_screenshot(png_bytes, grid_box=None):
+    # Crop, downsample and re-encode a raw screenshot entirely in memory
+    image = Image.open(BytesIO(png_bytes)).convert("RGB")
+    image = crop_to_used_range(image, grid_box)
+
+    if image.width > MAX_PHOTO_WIDTH:
+        image = image.resize((MAX_PHOTO_WIDTH, round(image.height * MAX_PHOTO_WIDTH / image.width)), Image.LANCZOS)
+
+    optimized_bytes = encode_within_budget(image)
+    logger.info(f"Screenshot optimized from {len(png_bytes)} to {len(optimized_bytes)} bytes ({image.width}x{image.height})")
+
+    return optimized_bytes
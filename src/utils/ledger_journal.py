@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import httplib2
+import threading
+from dotenv import load_dotenv
+from googleapiclient.errors import HttpError
+from utils.custom_logger import get_custom_logger
+from utils.file_store import locked_file, write_json_atomic
+from utils.sheets_scheduler import RETRYABLE_STATUSES
+
+load_dotenv()
+logger = get_custom_logger(__name__)
+
+# Define the directory for storing the ledger command journal
+journal_dir = os.path.normpath(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "journal")))
+
+# Entries older than this are pruned at startup
+JOURNAL_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+# An identical command resent in the same chat within this window resumes the unfinished original
+RESEND_WINDOW_SECONDS = int(os.getenv("LEDGER_RESEND_WINDOW_SECONDS", "600"))
+
+# Each step is retried this many times on timeouts and connection errors before the command fails
+STEP_RETRIES = int(os.getenv("LEDGER_STEP_RETRIES", "3"))
+STEP_RETRY_DELAY = 2.0
+
+journal_lock = threading.Lock()
+
+
+def get_idempotency_key(command, update):
+    # The key normally comes from the update_id, which stays the same when an update is redelivered.
+    # An operator's resend is a new update, so it is matched to the original by chat and command text
+    normalized_text = " ".join(update.message.text.lower().split())
+    fingerprint = hashlib.sha1(f"{update.message.chat_id}:{normalized_text}".encode()).hexdigest()
+    alias_key = f"resend-{fingerprint}"
+
+    with journal_lock:
+        alias = load_entry(alias_key)
+
+        if alias is not None and time.time() - alias["created_at"] < RESEND_WINDOW_SECONDS:
+            original = load_entry(alias["key"])
+
+            # Only an unfinished command is resumed; a resend after a success is a new entry
+            if original is not None and original["status"] == "pending":
+                logger.info(f"Matched resent command to unfinished '{alias['key']}'")
+                return alias["key"]
+
+        key = f"{command}-{update.update_id}"
+        _save_entry(alias_key, {"key": key, "created_at": time.time()})
+
+        return key
+
+
+def customer_lock(sheet_title):
+    # Serialises a customer's ledger writes and balance repairs across threads and fleet processes
+    if not os.path.exists(journal_dir):
+        os.makedirs(journal_dir)
+
+    return locked_file(os.path.join(journal_dir, f"customer-{hashlib.sha1(sheet_title.encode()).hexdigest()}"))
+
+
+def _entry_path(key):
+    return os.path.join(journal_dir, f"{key}.json")
+
+
+def _save_entry(key, entry):
+    if not os.path.exists(journal_dir):
+        os.makedirs(journal_dir)
+
+    # Write to a temporary file first so a crash never leaves a half-written entry
+    write_json_atomic(_entry_path(key), entry)
+
+
+def load_entry(key):
+    path = _entry_path(key)
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def begin_entry(key, command):
+    # Return the existing entry for a retried command, or start a new one
+    with journal_lock:
+        entry = load_entry(key)
+
+        if entry is None:
+            entry = {"command": command, "status": "pending", "steps": {}, "reply": None, "created_at": time.time()}
+            _save_entry(key, entry)
+        else:
+            logger.info(f"Resuming journaled command '{key}' with status '{entry['status']}'")
+
+        return entry
+
+
+def is_transient_error(error):
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+
+    return isinstance(error, (TimeoutError, socket.timeout, ConnectionError, httplib2.HttpLib2Error))
+
+
+def run_with_retries(key, step, action):
+    # Run an action, retrying it on timeouts and connection errors, without journaling its result
+    attempt = 0
+
+    while True:
+        try:
+            return action()
+        except Exception as e:
+            if not is_transient_error(e) or attempt >= STEP_RETRIES:
+                raise
+
+            attempt += 1
+            logger.error(f"Step '{step}' of '{key}' failed with {e}, retrying ({attempt}/{STEP_RETRIES})")
+            time.sleep(STEP_RETRY_DELAY * attempt)
+
+
+def run_step(key, step, action):
+    # Run a step once; on a retry the journaled result is returned instead of running it again
+    with journal_lock:
+        entry = load_entry(key)
+
+    if step in entry["steps"]:
+        return entry["steps"][step]
+
+    # Steps write absolute values to fixed ranges, so repeating one after a timeout is safe
+    result = run_with_retries(key, step, action)
+
+    with journal_lock:
+        entry = load_entry(key)
+        entry["steps"][step] = result
+        _save_entry(key, entry)
+
+    return result
+
+
+def complete_entry(key, reply):
+    with journal_lock:
+        entry = load_entry(key)
+        entry["status"] = "done"
+        entry["reply"] = reply
+        entry["completed_at"] = time.time()
+        _save_entry(key, entry)
+
+
+def prune_journal(max_age=JOURNAL_RETENTION_SECONDS):
+    if not os.path.exists(journal_dir):
+        return
+
+    now = time.time()
+
+    with journal_lock:
+        for filename in os.listdir(journal_dir):
+            if not filename.endswith(".json"):
+                continue
+
+            path = os.path.join(journal_dir, filename)
+
+            try:
+                with open(path, "r") as file:
+                    entry = json.load(file)
+
+                if now - entry["created_at"] > max_age:
+                    os.remove(path)
+            except Exception as e:
+                logger.error(f"Error pruning journal entry {filename}: {e}")
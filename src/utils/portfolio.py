@@ -0,0 +1,256 @@
+import os
+import json
+import threading
+from datetime import datetime
+from sortedcontainers import SortedList
+from utils.custom_logger import get_custom_logger
+from utils.file_store import locked_file, write_json_atomic
+from utils.sheet_directory import rebuild_directory, CUSTOMER_SHEET_SUFFIX
+from utils.sheets_scheduler import PRIORITY_BACKGROUND
+from utils.reconciliation import fetch_ledgers, parse_number
+
+logger = get_custom_logger(__name__)
+
+# Define the file path for storing the portfolio aggregates
+aggregates_file_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "credentials"))
+aggregates_file_path = os.path.normpath(os.path.join(aggregates_file_dir, "portfolio_aggregates.json"))
+
+# Postings are appended to this log and folded into the aggregates file every SNAPSHOT_INTERVAL postings
+events_file_path = os.path.normpath(os.path.join(aggregates_file_dir, "portfolio_events.jsonl"))
+SNAPSHOT_INTERVAL = 500
+
+
+def _day_key(date_str):
+    # Ledger dates are dd/mm/yyyy; aggregates are keyed by ISO date
+    return datetime.strptime(date_str, "%d/%m/%Y").strftime("%Y-%m-%d")
+
+
+def _empty_totals():
+    return {"deposits_eur": 0, "paid_eur": 0, "gbp_amount": 0, "weighted_percent": 0, "entries": 0, "deposits": 0}
+
+
+class PortfolioAggregates:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.customers = {}
+        self.days = {}
+        self.totals = _empty_totals()
+        self.debtors = SortedList()  # (-balance, customer) so the largest balances come first
+        self.logged_events = 0  # Postings in the event log since the last snapshot
+        self.held_events = None  # Postings that arrived during a rebuild, applied once it finishes
+
+    def _balance(self, customer):
+        totals = self.customers[customer]
+        return totals["deposits_eur"] - totals["paid_eur"]
+
+    def _apply(self, customer, day, deposits_eur=0, paid_eur=0, gbp_amount=0, percent=0, is_deposit=False):
+        # Add one ledger entry to the customer, day and portfolio totals
+        if customer in self.customers:
+            self.debtors.discard((-self._balance(customer), customer))
+        else:
+            self.customers[customer] = _empty_totals()
+
+        for totals in (self.customers[customer], self.days.setdefault(day, _empty_totals()), self.totals):
+            totals["deposits_eur"] += deposits_eur
+            totals["paid_eur"] += paid_eur
+            totals["gbp_amount"] += gbp_amount
+            totals["weighted_percent"] += gbp_amount * percent
+            totals["entries"] += 1
+            totals["deposits"] += 1 if is_deposit else 0
+
+        self.debtors.add((-self._balance(customer), customer))
+
+    def _record(self, customer, day, row, **amounts):
+        with self.lock:
+            if self.held_events is not None:
+                self.held_events.append((customer, day, row, amounts))
+                return
+
+            self._apply(customer, day, **amounts)
+            self._log(customer, day, amounts)
+
+    def record_deposit(self, customer, date_str, gbp_amount, percent, eur_amount, row=None):
+        self._record(customer, _day_key(date_str), row, deposits_eur=eur_amount, gbp_amount=gbp_amount, percent=percent, is_deposit=True)
+
+    def record_payment(self, customer, date_str, eur_amount, row=None):
+        self._record(customer, _day_key(date_str), row, paid_eur=eur_amount)
+
+    def summary(self, top=5):
+        # Every figure is read from maintained totals, so this does not depend on the number of customers
+        with self.lock:
+            today = self.days.get(datetime.now().strftime("%Y-%m-%d"), _empty_totals())
+            gbp_amount = self.totals["gbp_amount"]
+
+            return {
+                "customers": len(self.customers),
+                "deposits_eur": self.totals["deposits_eur"],
+                "paid_eur": self.totals["paid_eur"],
+                "outstanding_eur": self.totals["deposits_eur"] - self.totals["paid_eur"],
+                "effective_percent": self.totals["weighted_percent"] / gbp_amount if gbp_amount else 0,
+                "today_deposits_eur": today["deposits_eur"],
+                "today_deposits": today["deposits"],
+                "top_debtors": [(customer, -negative_balance) for negative_balance, customer in self.debtors[:top] if negative_balance < 0]
+            }
+
+    def hold_events(self):
+        # Keep postings back while a rebuild reads the ledgers, so none are lost when it replaces the totals
+        with self.lock:
+            self.held_events = []
+
+    def release_events(self):
+        # Apply the postings held back by a rebuild that did not finish
+        with self.lock:
+            held_events, self.held_events = self.held_events or [], None
+
+            for customer, day, _, amounts in held_events:
+                self._apply(customer, day, **amounts)
+                self._log(customer, day, amounts)
+
+    def rebuild(self, ledgers):
+        # Replace the aggregates with totals recomputed from the ledger rows of every customer
+        with self.lock:
+            self.customers = {}
+            self.days = {}
+            self.totals = _empty_totals()
+            self.debtors = SortedList()
+
+            for title, (rows, _) in ledgers.items():
+                customer = title.replace(CUSTOMER_SHEET_SUFFIX, '')
+
+                for row in rows[1:]:
+                    row = row + [""] * (8 - len(row))
+
+                    try:
+                        day = _day_key(str(row[0]))
+                    except ValueError:
+                        logger.error(f"Skipping row with invalid date '{row[0]}' in '{title}'")
+                        continue
+
+                    if row[6] != "":
+                        self._apply(customer, day, deposits_eur=parse_number(row[6]), gbp_amount=parse_number(row[2]), percent=parse_number(row[5]), is_deposit=True)
+                    elif row[7] != "":
+                        self._apply(customer, day, paid_eur=parse_number(row[7]))
+
+            # A held posting whose row was already written when its tab was read is counted in the rows above
+            for customer, day, row, amounts in self.held_events or []:
+                rows = ledgers.get(f"{customer}{CUSTOMER_SHEET_SUFFIX}", ([], []))[0]
+
+                if row is None or len(rows) < row:
+                    self._apply(customer, day, **amounts)
+
+            self.held_events = None
+            self._save()
+
+    def _log(self, customer, day, amounts):
+        # Append one posting instead of rewriting every customer and day, taking a snapshot now and then
+        if not os.path.exists(aggregates_file_dir):
+            os.makedirs(aggregates_file_dir)
+
+        with locked_file(aggregates_file_path):
+            with open(events_file_path, "a") as file:
+                file.write(json.dumps({"customer": customer, "day": day, "amounts": amounts}) + "\n")
+
+        self.logged_events += 1
+
+        if self.logged_events >= SNAPSHOT_INTERVAL:
+            self._save()
+
+    def _save(self):
+        # Write a snapshot of the aggregates and empty the event log it now includes
+        if not os.path.exists(aggregates_file_dir):
+            os.makedirs(aggregates_file_dir)
+
+        with locked_file(aggregates_file_path):
+            write_json_atomic(aggregates_file_path, {"customers": self.customers, "days": self.days, "totals": self.totals})
+            open(events_file_path, "w").close()
+
+        self.logged_events = 0
+
+    def load(self):
+        # Read the latest snapshot, then replay the postings logged since it was taken
+        with self.lock:
+            if os.path.exists(aggregates_file_path):
+                with open(aggregates_file_path, "r") as file:
+                    data = json.load(file)
+
+                self.customers = data["customers"]
+                self.days = data["days"]
+                self.totals = data["totals"]
+                self.debtors = SortedList((-self._balance(customer), customer) for customer in self.customers)
+
+            if os.path.exists(events_file_path):
+                with open(events_file_path, "r") as file:
+                    for line in file:
+                        if line.strip():
+                            event = json.loads(line)
+                            self._apply(event["customer"], event["day"], **event["amounts"])
+                            self.logged_events += 1
+
+
+portfolio = PortfolioAggregates()
+portfolio.load()
+
+event_forwarder = None  # Set in worker processes, where another process owns the aggregates
+
+
+def forward_events(forwarder):
+    global event_forwarder
+    event_forwarder = forwarder
+
+
+def apply_event(event):
+    kind, args = event
+
+    if kind == "deposit":
+        portfolio.record_deposit(*args)
+    elif kind == "payment":
+        portfolio.record_payment(*args)
+
+
+def record_deposit(customer, date_str, gbp_amount, percent, eur_amount, row=None):
+    # row is the ledger row the deposit was written to, so a rebuild running at the same time counts it once
+    event = ("deposit", (customer, date_str, gbp_amount, percent, eur_amount, row))
+
+    if event_forwarder:
+        event_forwarder(event)
+    else:
+        apply_event(event)
+
+    return True
+
+
+def record_payment(customer, date_str, eur_amount, row=None):
+    event = ("payment", (customer, date_str, eur_amount, row))
+
+    if event_forwarder:
+        event_forwarder(event)
+    else:
+        apply_event(event)
+
+    return True
+
+
+def get_portfolio_summary(top=5):
+    return portfolio.summary(top)
+
+
+def rebuild_portfolio(sheet_service):
+    # Recompute the aggregates from the sheets using batched ledger reads
+    ledgers = {}
+    sheets_by_spreadsheet = {}
+
+    for title, spreadsheet_id in rebuild_directory(sheet_service, PRIORITY_BACKGROUND).items():
+        if title.endswith(CUSTOMER_SHEET_SUFFIX):
+            sheets_by_spreadsheet.setdefault(spreadsheet_id, []).append(title)
+
+    portfolio.hold_events()
+
+    try:
+        for spreadsheet_id, sheet_titles in sheets_by_spreadsheet.items():
+            ledgers.update(fetch_ledgers(sheet_service, spreadsheet_id, sheet_titles))
+    except Exception:
+        portfolio.release_events()
+        raise
+
+    portfolio.rebuild(ledgers)
+    logger.info(f"Portfolio aggregates rebuilt from {len(ledgers)} sheets")
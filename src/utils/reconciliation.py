@@ -0,0 +1,159 @@
+from contextlib import ExitStack
+from collections import defaultdict
+from utils.custom_logger import get_custom_logger
+from utils.sheets_scheduler import execute_request, PRIORITY_BACKGROUND
+from utils.sheet_directory import rebuild_directory, CUSTOMER_SHEET_SUFFIX
+from utils.ledger_journal import customer_lock
+
+logger = get_custom_logger(__name__)
+
+# Each tab contributes two ranges, so this keeps every batchGet well below URL length limits
+TABS_PER_BATCH = 100
+
+# Ledger columns (zero-based) and the running total cells they must agree with
+EUR_AMOUNT_COLUMN = 6  # Column G
+EUR_PAID_COLUMN = 7  # Column H
+TOTAL_DUE_CELL = "K1"
+TOTAL_PAID_CELL = "K2"
+BALANCE_CELL = "K3"
+
+
+def parse_number(value):
+    # Blank cells count as zero; whole numbers stay ints so they are written back unchanged
+    if value in ("", None):
+        return 0
+
+    try:
+        number = float(str(value).replace(',', '')) if not isinstance(value, (int, float)) else value
+    except ValueError:
+        return 0
+
+    return int(number) if float(number).is_integer() else number
+
+
+def _column(rows, index):
+    # Pull one column out of the ledger rows, skipping the header row
+    return [parse_number(row[index]) if len(row) > index else 0 for row in rows[1:]]
+
+
+def _cell(totals, index):
+    return parse_number(totals[index][0]) if len(totals) > index and totals[index] else 0
+
+
+def compute_totals(rows):
+    # Sum each EUR column over the ledger rows; a plain loop, since numpy is not a dependency and the API calls dominate
+    total_due = sum(_column(rows, EUR_AMOUNT_COLUMN))
+    total_paid = sum(_column(rows, EUR_PAID_COLUMN))
+
+    return {TOTAL_DUE_CELL: total_due, TOTAL_PAID_CELL: total_paid, BALANCE_CELL: total_due - total_paid}
+
+
+def get_ledger_totals(sheet_service, spreadsheet_id, sheet_title):
+    # Read one customer's ledger rows and recompute its running totals from them
+    response = execute_request(
+        sheet_service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id,
+            range=f"'{sheet_title}'!A:H",
+            valueRenderOption="UNFORMATTED_VALUE"
+        )
+    )
+
+    return compute_totals(response.get('values', []))
+
+
+def fetch_ledgers(sheet_service, spreadsheet_id, sheet_titles):
+    # Fetch A:H and K1:K4 for many tabs per values.batchGet call
+    ledgers = {}
+
+    for start in range(0, len(sheet_titles), TABS_PER_BATCH):
+        batch = sheet_titles[start:start + TABS_PER_BATCH]
+        ranges = [sheet_range for title in batch for sheet_range in (f"'{title}'!A:H", f"'{title}'!K1:K4")]
+
+        response = execute_request(
+            sheet_service.spreadsheets().values().batchGet(
+                spreadsheetId=spreadsheet_id,
+                ranges=ranges,
+                valueRenderOption="UNFORMATTED_VALUE"
+            ),
+            priority=PRIORITY_BACKGROUND
+        )
+        value_ranges = response.get('valueRanges', [])
+
+        for index, title in enumerate(batch):
+            rows = value_ranges[2 * index].get('values', [])
+            totals = value_ranges[2 * index + 1].get('values', [])
+            ledgers[title] = (rows, totals)
+
+    return ledgers
+
+
+def find_drift(sheet_title, rows, totals):
+    expected_totals = compute_totals(rows)
+    recorded_totals = {TOTAL_DUE_CELL: _cell(totals, 0), TOTAL_PAID_CELL: _cell(totals, 1), BALANCE_CELL: _cell(totals, 2)}
+
+    return [
+        {"sheet": sheet_title, "cell": cell, "recorded": recorded_totals[cell], "expected": expected}
+        for cell, expected in expected_totals.items()
+        if abs(recorded_totals[cell] - expected) > 0.005
+    ]
+
+
+def verify_drift(sheet_service, spreadsheet_id, drifts):
+    # Re-read the drifted tabs right before repairing, so a deposit or payment posted since the first
+    # read is included in the expected totals instead of being overwritten with a stale value
+    drifted_titles = sorted({drift['sheet'] for drift in drifts})
+    ledgers = fetch_ledgers(sheet_service, spreadsheet_id, drifted_titles)
+
+    return [drift for title, (rows, totals) in ledgers.items() for drift in find_drift(title, rows, totals)]
+
+
+def repair_drift(sheet_service, spreadsheet_id, drifts):
+    # Write every corrected total of one spreadsheet in a single values.batchUpdate call
+    execute_request(
+        sheet_service.spreadsheets().values().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={
+                "valueInputOption": "RAW",
+                "data": [{"range": f"'{drift['sheet']}'!{drift['cell']}", "values": [[drift['expected']]]} for drift in drifts]
+            }
+        ),
+        kind="write",
+        priority=PRIORITY_BACKGROUND
+    )
+
+
+def reconcile_balances(sheet_service, repair=False):
+    # Check every customer's running totals against its ledger rows, optionally fixing any drift
+    sheets_by_spreadsheet = defaultdict(list)
+
+    for title, spreadsheet_id in rebuild_directory(sheet_service, PRIORITY_BACKGROUND).items():
+        if title.endswith(CUSTOMER_SHEET_SUFFIX):
+            sheets_by_spreadsheet[spreadsheet_id].append(title)
+
+    all_drifts = []
+
+    for spreadsheet_id, sheet_titles in sheets_by_spreadsheet.items():
+        ledgers = fetch_ledgers(sheet_service, spreadsheet_id, sheet_titles)
+        drifts = [drift for title, (rows, totals) in ledgers.items() for drift in find_drift(title, rows, totals)]
+
+        if repair and drifts:
+            # Hold the drifted customers' locks so a ledger command between its row write and its balance
+            # update is never repaired to a total that already counts its amount
+            with ExitStack() as locks:
+                for title in sorted({drift['sheet'] for drift in drifts}):
+                    locks.enter_context(customer_lock(title))
+
+                drifts = verify_drift(sheet_service, spreadsheet_id, drifts)
+
+                if drifts:
+                    repair_drift(sheet_service, spreadsheet_id, drifts)
+
+        all_drifts.extend(drifts)
+
+    checked = sum(len(titles) for titles in sheets_by_spreadsheet.values())
+
+    for drift in all_drifts:
+        logger.error(f"Balance drift in '{drift['sheet']}' {drift['cell']}: recorded {drift['recorded']}, expected {drift['expected']}")
+
+    logger.info(f"Reconciliation checked {checked} sheets and found {len(all_drifts)} drifted totals{' (repaired)' if repair and all_drifts else ''}")
+    return all_drifts
@@ -0,0 +1,239 @@
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+from dotenv import load_dotenv
+from telegram import InputMediaPhoto
+from telegram.error import RetryAfter, BadRequest, NetworkError
+from utils.custom_logger import get_custom_logger
+from utils.sheets_scheduler import TokenBucket, PROCESS_COUNT
+
+load_dotenv()
+logger = get_custom_logger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+# Telegram allows about 30 messages per second overall, one per second per chat and 20 per minute per group
+PRIVATE_CHAT_INTERVAL = 1.0
+GROUP_CHAT_INTERVAL = 3.0
+
+# Answers to callback and inline queries expire within seconds, so they have their own queue served ahead
+# of every chat; they are not chat messages, so only the global limit applies to them
+ANSWER_QUEUE = "answers"
+
+# Sends failing with a timeout or connection error are retried this many times with a growing delay
+SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))
+SEND_RETRY_DELAY = 2.0
+
+
+class SendQueue:
+    def __init__(self, messages_per_second=30, senders=4):
+        # Bursts are capped at one second of sends, since Telegram enforces its limit per second
+        self.bucket = TokenBucket(messages_per_second * 60, capacity=max(1, messages_per_second))
+        self.senders = senders
+        self.bot = None
+
+        self.chats = OrderedDict()  # chat_id -> pending items, in the order they were queued
+        self.answers = deque()  # Pending callback and inline query answers
+        self.next_send = {}  # chat_id -> earliest time the chat can receive another message
+        self.in_flight = set()  # Chats with a message being sent, so each chat's messages stay in order
+        self.paused_until = 0  # Set when Telegram answers with RetryAfter
+        self.condition = threading.Condition()
+        self.threads = []
+
+    def start(self, bot):
+        with self.condition:
+            self.bot = bot
+
+            if self.threads:
+                return
+
+            for index in range(self.senders):
+                thread = threading.Thread(target=self._sender, name=f"send-queue-{index}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def put(self, chat_id, item):
+        with self.condition:
+            self.chats.setdefault(chat_id, deque()).append(item)
+            self.condition.notify()
+
+    def put_answer(self, item):
+        with self.condition:
+            self.answers.append(item)
+            self.condition.notify()
+
+    def get_queue_depth(self):
+        with self.condition:
+            return len(self.answers) + sum(len(items) for items in self.chats.values())
+
+    def _chat_interval(self, chat_id):
+        return GROUP_CHAT_INTERVAL if chat_id < 0 else PRIVATE_CHAT_INTERVAL
+
+    def _take_item(self, chat_id):
+        items = self.chats[chat_id]
+        item = items.popleft()
+
+        # Merge consecutive plain text replies to the same command into one message, so each reply still quotes its command
+        if item["kind"] == "text" and item.get("reply_markup") is None:
+            while (items and items[0]["kind"] == "text" and items[0].get("reply_markup") is None
+                   and items[0].get("reply_to_message_id") == item.get("reply_to_message_id")):
+                merged_text = f"{item['text']}\n\n{items[0]['text']}"
+
+                if len(merged_text) > MAX_MESSAGE_LENGTH:
+                    break
+
+                item = {"kind": "text", "text": merged_text, "reply_markup": None, "reply_to_message_id": item.get("reply_to_message_id")}
+                items.popleft()
+
+        if not items:
+            del self.chats[chat_id]
+
+        return item
+
+    def _next_ready(self):
+        # Return the first chat allowed to receive a message now, or how long until one is
+        now = time.monotonic()
+        wait_time = None
+
+        if now < self.paused_until:
+            return None, self.paused_until - now
+
+        if self.answers:
+            return ANSWER_QUEUE, None
+
+        for chat_id in self.chats:
+            if chat_id in self.in_flight:
+                continue
+
+            ready_at = self.next_send.get(chat_id, 0)
+
+            if ready_at <= now:
+                return chat_id, None
+
+            wait_time = ready_at - now if wait_time is None else min(wait_time, ready_at - now)
+
+        return None, wait_time
+
+    def _send(self, chat_id, item):
+        if item["kind"] == "text":
+            self.bot.send_message(
+                chat_id=chat_id,
+                text=item["text"],
+                reply_markup=item.get("reply_markup"),
+                reply_to_message_id=item.get("reply_to_message_id"),
+                allow_sending_without_reply=True
+            )
+        elif item["kind"] == "edit":
+            self.bot.edit_message_text(chat_id=chat_id, message_id=item["message_id"], text=item["text"], reply_markup=item.get("reply_markup"))
+        elif item["kind"] == "answer_callback":
+            self.bot.answer_callback_query(callback_query_id=item["callback_query_id"])
+        elif item["kind"] == "inline_answer":
+            self.bot.answer_inline_query(item["inline_query_id"], item["results"], **item["options"])
+        elif len(item["photos"]) == 1:
+            photo, caption = item["photos"][0]
+            self.bot.send_photo(chat_id=chat_id, photo=photo, caption=caption)
+        else:
+            media = [InputMediaPhoto(media=photo, caption=caption) for photo, caption in item["photos"]]
+            self.bot.send_media_group(chat_id=chat_id, media=media)
+
+    def _sender(self):
+        while True:
+            with self.condition:
+                chat_id, wait_time = self._next_ready()
+
+                while chat_id is None:
+                    self.condition.wait(wait_time)
+                    chat_id, wait_time = self._next_ready()
+
+                if chat_id == ANSWER_QUEUE:
+                    item = self.answers.popleft()
+                else:
+                    item = self._take_item(chat_id)
+                    self.in_flight.add(chat_id)
+
+            self.bucket.acquire()
+            delay = 0 if chat_id == ANSWER_QUEUE else self._chat_interval(chat_id)
+
+            try:
+                self._send(chat_id, item)
+            except RetryAfter as e:
+                logger.error(f"Telegram flood limit hit, pausing sends for {e.retry_after}s")
+
+                with self.condition:
+                    # Put the message back at the front of its chat and pause every sender
+                    self._requeue(chat_id, item)
+                    self.paused_until = time.monotonic() + e.retry_after
+            except BadRequest as e:
+                # BadRequest is a NetworkError in python-telegram-bot, but sending it again would fail the same way
+                logger.error(f"Telegram rejected message to chat {chat_id}: {e}")
+            except NetworkError as e:
+                item["attempts"] = item.get("attempts", 0) + 1
+
+                if item["attempts"] > SEND_RETRIES:
+                    logger.error(f"Error sending message to chat {chat_id}, giving up after {SEND_RETRIES} retries: {e}")
+                else:
+                    delay = SEND_RETRY_DELAY * (2 ** (item["attempts"] - 1))
+                    logger.error(f"Error sending message to chat {chat_id}, retrying in {delay:.0f}s: {e}")
+
+                    with self.condition:
+                        self._requeue(chat_id, item)
+            except Exception as e:
+                logger.error(f"Error sending message to chat {chat_id}: {e}")
+            finally:
+                with self.condition:
+                    # Answers are retried straight away, since waiting would let the query expire
+                    if chat_id != ANSWER_QUEUE:
+                        self.in_flight.discard(chat_id)
+                        self.next_send[chat_id] = time.monotonic() + delay
+
+                    self.condition.notify_all()
+
+    def _requeue(self, chat_id, item):
+        # Put an item back at the front of its chat, ahead of anything queued since
+        if chat_id == ANSWER_QUEUE:
+            self.answers.appendleft(item)
+            return
+
+        self.chats.setdefault(chat_id, deque()).appendleft(item)
+        self.chats.move_to_end(chat_id, last=False)
+
+
+# Every fleet process sends to Telegram with the same bot token, so the global limit is split between them
+send_queue = SendQueue(
+    messages_per_second=int(os.getenv("TELEGRAM_MESSAGES_PER_SECOND", "30")) / PROCESS_COUNT,
+    senders=int(os.getenv("TELEGRAM_SENDERS", "4"))
+)
+
+
+def start_send_queue(bot):
+    send_queue.start(bot)
+
+
+def queue_reply(update, text, reply_markup=None):
+    # Queue a text reply to the chat the update came from, quoting the operator's command like reply_text did
+    reply_to_message_id = update.message.message_id if update.message else None
+    send_queue.put(update.effective_chat.id, {"kind": "text", "text": text, "reply_markup": reply_markup, "reply_to_message_id": reply_to_message_id})
+
+
+def queue_edit(query, text, reply_markup=None):
+    # Queue an edit of the message a callback query's button belongs to
+    send_queue.put(query.message.chat_id, {"kind": "edit", "message_id": query.message.message_id, "text": text, "reply_markup": reply_markup})
+
+
+def queue_callback_answer(query):
+    # Queue the answer that stops the button's loading indicator, ahead of every chat's messages
+    send_queue.put_answer({"kind": "answer_callback", "callback_query_id": query.id})
+
+
+def queue_inline_answer(inline_query, results, **options):
+    send_queue.put_answer({"kind": "inline_answer", "inline_query_id": inline_query.id, "results": results, "options": options})
+
+
+def queue_photos(chat_id, photos):
+    # photos is a list of (bytes, caption); a single photo is sent with send_photo
+    send_queue.put(chat_id, {"kind": "photos", "photos": photos})
+
+
+def get_send_queue_depth():
+    return send_queue.get_queue_depth()
@@ -0,0 +1,322 @@
+import os
+import json
+import time
+import zlib
+import threading
+from dotenv import load_dotenv
+from utils.custom_logger import get_custom_logger
+from utils.file_store import locked_file, write_json_atomic
+from utils.sheets_scheduler import execute_request, PRIORITY_USER, PRIORITY_BACKGROUND
+
+load_dotenv()
+logger = get_custom_logger(__name__)
+
+# Define the file path for storing the customer to spreadsheet directory
+directory_file_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "credentials"))
+directory_file_path = os.path.normpath(os.path.join(directory_file_dir, "sheet_directory.json"))
+
+directory_lock = threading.Lock()
+directory = {}  # Maps a sheet title to the ID of the spreadsheet holding it
+directory_listeners = []  # Called with the added sheet title, or None when the whole directory changed
+directory_file_mtime = None  # Modification time of the directory file as last read or written by this process
+duplicate_sheets = {}  # Sheet title -> IDs of the other spreadsheets holding a tab of the same title, as of the last rebuild
+
+# A missed lookup rescans the spreadsheets at most this often
+RESCAN_INTERVAL_SECONDS = 30
+last_rescan = 0
+
+# Only customer tabs count towards shard sizes and are moved when rebalancing
+CUSTOMER_SHEET_SUFFIX = " GBP/EUR"
+
+
+def get_spreadsheet_ids():
+    # GOOGLE_SHEET_FILE_IDS lists every shard; a single GOOGLE_SHEET_FILE_ID is one shard
+    file_ids = os.getenv("GOOGLE_SHEET_FILE_IDS") or os.getenv("GOOGLE_SHEET_FILE_ID") or ""
+    return [file_id.strip() for file_id in file_ids.split(",") if file_id.strip()]
+
+
+def get_spreadsheet_url(spreadsheet_id):
+    # GOOGLE_SHEET_URLS is aligned with GOOGLE_SHEET_FILE_IDS; fall back to the plain edit URL
+    spreadsheet_ids = get_spreadsheet_ids()
+    urls = [url.strip() for url in (os.getenv("GOOGLE_SHEET_URLS") or os.getenv("GOOGLE_SHEET_URL") or "").split(",")]
+
+    if spreadsheet_id in spreadsheet_ids:
+        index = spreadsheet_ids.index(spreadsheet_id)
+
+        if index < len(urls) and urls[index]:
+            return urls[index]
+
+    return f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit"
+
+
+def _locked_directory_file():
+    # Fleet processes share the directory file, so every change to it is made while holding its lock
+    if not os.path.exists(directory_file_dir):
+        os.makedirs(directory_file_dir)
+
+    return locked_file(directory_file_path)
+
+
+def _file_changed():
+    return os.path.exists(directory_file_path) and os.path.getmtime(directory_file_path) != directory_file_mtime
+
+
+def _save_directory():
+    write_json_atomic(directory_file_path, directory)
+
+    global directory_file_mtime
+    directory_file_mtime = os.path.getmtime(directory_file_path)
+
+
+def _load_directory():
+    global directory_file_mtime
+
+    if os.path.exists(directory_file_path):
+        with open(directory_file_path, "r") as file:
+            directory.clear()
+            directory.update(json.load(file))
+
+        directory_file_mtime = os.path.getmtime(directory_file_path)
+
+
+def _notify_listeners(sheet_title=None):
+    for listener in directory_listeners:
+        try:
+            listener(sheet_title)
+        except Exception as e:
+            logger.error(f"Error notifying sheet directory listener: {e}")
+
+
+def add_directory_listener(listener):
+    directory_listeners.append(listener)
+
+
+def _reload_if_changed():
+    # Start a change from the file, which may hold tabs registered by other processes
+    if not _file_changed():
+        return False
+
+    _load_directory()
+    return True
+
+
+def refresh_directory():
+    # Pick up changes another process saved to the directory file
+    if not _file_changed():
+        return
+
+    with directory_lock:
+        _load_directory()
+
+    _notify_listeners()
+
+
+def get_spreadsheet_tabs(sheet_service, spreadsheet_id, priority=PRIORITY_USER):
+    # Only request tab properties so the response stays small as the tab count grows
+    spreadsheet_info = execute_request(
+        sheet_service.spreadsheets().get(spreadsheetId=spreadsheet_id, fields="sheets.properties(sheetId,title)"),
+        priority=priority
+    )
+
+    return {sheet['properties']['title']: sheet['properties']['sheetId'] for sheet in spreadsheet_info.get('sheets', [])}
+
+
+def rebuild_directory(sheet_service, priority=PRIORITY_USER):
+    # Scan every shard and rebuild the directory from the tabs it actually holds
+    holders = {}
+
+    for spreadsheet_id in get_spreadsheet_ids():
+        for title in get_spreadsheet_tabs(sheet_service, spreadsheet_id, priority):
+            holders.setdefault(title, []).append(spreadsheet_id)
+
+    refresh_directory()
+    new_directory = {}
+    duplicate_sheets.clear()
+
+    for title, spreadsheet_ids in holders.items():
+        # An interrupted move leaves the tab in two spreadsheets; the directory only points at the destination
+        # once the source is deleted, so the spreadsheet it points at now holds the current copy
+        current_id = directory.get(title)
+        new_directory[title] = current_id if current_id in spreadsheet_ids else spreadsheet_ids[0]
+
+        # Only customer tabs count; every spreadsheet may have its own default tab with the same title
+        if len(spreadsheet_ids) > 1 and title.endswith(CUSTOMER_SHEET_SUFFIX):
+            duplicate_sheets[title] = [spreadsheet_id for spreadsheet_id in spreadsheet_ids if spreadsheet_id != new_directory[title]]
+            logger.error(f"Sheet '{title}' exists in {len(spreadsheet_ids)} spreadsheets, using {new_directory[title]}; run the rebalance tool to remove the other copies")
+
+    with directory_lock, _locked_directory_file():
+        directory.clear()
+        directory.update(new_directory)
+        _save_directory()
+
+    _notify_listeners()
+
+    logger.info(f"Sheet directory rebuilt with {len(new_directory)} tabs across {len(get_spreadsheet_ids())} spreadsheets")
+    return dict(new_directory)
+
+
+def get_directory(sheet_service=None):
+    # Rebuild on first use when there is no persisted directory yet
+    if not directory and sheet_service is not None:
+        rebuild_directory(sheet_service)
+
+    with directory_lock:
+        return dict(directory)
+
+
+def register_sheet(sheet_title, spreadsheet_id):
+    with directory_lock, _locked_directory_file():
+        reloaded = _reload_if_changed()
+        directory[sheet_title] = spreadsheet_id
+        _save_directory()
+
+    _notify_listeners(None if reloaded else sheet_title)
+
+
+def unregister_sheet(sheet_title):
+    with directory_lock, _locked_directory_file():
+        _reload_if_changed()
+        directory.pop(sheet_title, None)
+        _save_directory()
+
+    _notify_listeners()
+
+
+def resolve_spreadsheet_id(sheet_service, sheet_title):
+    # Return the ID of the spreadsheet holding the tab, or None if no shard has it
+    global last_rescan
+
+    refresh_directory()
+    spreadsheet_id = get_directory(sheet_service).get(sheet_title)
+
+    # The tab may have been added outside the bot, so rescan, but not on every miss of a new or mistyped name
+    if spreadsheet_id is None and sheet_service is not None and time.monotonic() - last_rescan > RESCAN_INTERVAL_SECONDS:
+        last_rescan = time.monotonic()
+        spreadsheet_id = rebuild_directory(sheet_service).get(sheet_title)
+
+    return spreadsheet_id
+
+
+def get_shard_sizes(sheet_service=None):
+    sizes = {spreadsheet_id: 0 for spreadsheet_id in get_spreadsheet_ids()}
+
+    for title, spreadsheet_id in get_directory(sheet_service).items():
+        if title.endswith(CUSTOMER_SHEET_SUFFIX) and spreadsheet_id in sizes:
+            sizes[spreadsheet_id] += 1
+
+    return sizes
+
+
+def place_sheet(sheet_service, sheet_title):
+    # Choose the spreadsheet a new customer tab goes into according to SHEET_PLACEMENT_POLICY
+    spreadsheet_ids = get_spreadsheet_ids()
+
+    if not spreadsheet_ids:
+        raise ValueError("No spreadsheets configured in GOOGLE_SHEET_FILE_IDS")
+
+    policy = os.getenv("SHEET_PLACEMENT_POLICY", "least_tabs")
+
+    if policy == "hash":
+        return spreadsheet_ids[zlib.crc32(sheet_title.encode()) % len(spreadsheet_ids)]
+
+    if policy != "least_tabs":
+        logger.error(f"Unknown placement policy '{policy}', falling back to 'least_tabs'")
+
+    sizes = get_shard_sizes(sheet_service)
+    return min(spreadsheet_ids, key=lambda spreadsheet_id: sizes[spreadsheet_id])
+
+
+def move_sheet(sheet_service, sheet_title, source_id, destination_id):
+    # Copy the tab to the destination spreadsheet and restore its title before deleting the original
+    source_tabs = get_spreadsheet_tabs(sheet_service, source_id, PRIORITY_BACKGROUND)
+
+    copied = execute_request(
+        sheet_service.spreadsheets().sheets().copyTo(
+            spreadsheetId=source_id,
+            sheetId=source_tabs[sheet_title],
+            body={"destinationSpreadsheetId": destination_id}
+        ),
+        kind="write",
+        priority=PRIORITY_BACKGROUND
+    )
+
+    execute_request(
+        sheet_service.spreadsheets().batchUpdate(
+            spreadsheetId=destination_id,
+            body={"requests": [{"updateSheetProperties": {
+                "properties": {"sheetId": copied["sheetId"], "title": sheet_title},
+                "fields": "title"
+            }}]}
+        ),
+        kind="write",
+        priority=PRIORITY_BACKGROUND
+    )
+
+    execute_request(
+        sheet_service.spreadsheets().batchUpdate(
+            spreadsheetId=source_id,
+            body={"requests": [{"deleteSheet": {"sheetId": source_tabs[sheet_title]}}]}
+        ),
+        kind="write",
+        priority=PRIORITY_BACKGROUND
+    )
+
+    register_sheet(sheet_title, destination_id)
+    logger.info(f"Moved sheet '{sheet_title}' from {source_id} to {destination_id}")
+
+
+def remove_duplicate_sheets(sheet_service):
+    # Delete the stale copies an interrupted move left behind, keeping the copy the directory points at
+    removed = 0
+
+    for title, spreadsheet_ids in dict(duplicate_sheets).items():
+        for spreadsheet_id in spreadsheet_ids:
+            sheet_id = get_spreadsheet_tabs(sheet_service, spreadsheet_id, PRIORITY_BACKGROUND)[title]
+
+            execute_request(
+                sheet_service.spreadsheets().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body={"requests": [{"deleteSheet": {"sheetId": sheet_id}}]}
+                ),
+                kind="write",
+                priority=PRIORITY_BACKGROUND
+            )
+
+            removed += 1
+            logger.info(f"Removed duplicate of sheet '{title}' from {spreadsheet_id}, keeping the copy in {get_directory()[title]}")
+
+        duplicate_sheets.pop(title, None)
+
+    return removed
+
+
+def rebalance_sheets(sheet_service):
+    # Move tabs from the fullest spreadsheets to the emptiest until tab counts differ by at most one
+    if not get_spreadsheet_ids():
+        logger.error("No spreadsheets configured in GOOGLE_SHEET_FILE_IDS, nothing to rebalance")
+        return 0
+
+    rebuild_directory(sheet_service, PRIORITY_BACKGROUND)
+    remove_duplicate_sheets(sheet_service)
+    moves = 0
+
+    while True:
+        sizes = get_shard_sizes()
+        fullest = max(sizes, key=sizes.get)
+        emptiest = min(sizes, key=sizes.get)
+
+        if sizes[fullest] - sizes[emptiest] <= 1:
+            break
+
+        sheet_title = next(
+            title for title, spreadsheet_id in sorted(get_directory().items())
+            if title.endswith(CUSTOMER_SHEET_SUFFIX) and spreadsheet_id == fullest
+        )
+        move_sheet(sheet_service, sheet_title, fullest, emptiest)
+        moves += 1
+
+    logger.info(f"Rebalancing finished after moving {moves} sheets")
+    return moves
+
+
+_load_directory()
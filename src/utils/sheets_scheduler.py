@@ -0,0 +1,199 @@
+import os
+import time
+import heapq
+import random
+import itertools
+import threading
+from dotenv import load_dotenv
+from concurrent.futures import Future
+from googleapiclient.errors import HttpError
+from utils.custom_logger import get_custom_logger
+
+load_dotenv()
+logger = get_custom_logger(__name__)
+
+# Lower numbers are served first
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 1
+
+PRIORITY_NAMES = {PRIORITY_USER: "user", PRIORITY_BACKGROUND: "background"}
+
+# Statuses worth retrying: quota exceeded and transient backend errors
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# At most this many seconds of quota can be spent in one burst after the scheduler was idle
+BURST_SECONDS = 5
+
+# The intake process and every fleet worker each run a scheduler, so the project quota is split evenly between them
+PROCESS_COUNT = int(os.getenv("WORKER_PROCESSES", "0")) + 1
+
+
+class TokenBucket:
+    def __init__(self, requests_per_minute, capacity=None):
+        # The bucket holds a full minute of requests unless a smaller burst is given
+        self.capacity = float(capacity if capacity is not None else requests_per_minute)
+        self.tokens = self.capacity
+        self.refill_rate = requests_per_minute / 60.0  # Tokens added per second
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    def acquire(self):
+        # Block until a token is available, then consume it
+        while True:
+            with self.lock:
+                self._refill()
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait_time = (1 - self.tokens) / self.refill_rate
+
+            time.sleep(wait_time)
+
+
+class SheetsScheduler:
+    def __init__(self, read_quota, write_quota, workers=4, max_retries=5, base_delay=1.0, max_delay=32.0):
+        self.buckets = {"read": self._quota_bucket(read_quota), "write": self._quota_bucket(write_quota)}
+        self.workers = workers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.queue = []
+        self.counter = itertools.count()  # Keeps FIFO order within the same priority
+        self.condition = threading.Condition()
+        self.threads = []
+
+        # httplib2.Http is not thread-safe, so every worker executes requests with its own authorized Http
+        self.http_factory = None
+        self.thread_local = threading.local()
+
+    def _quota_bucket(self, quota):
+        # The burst comes out of the refill rate, so no 60 second window ever sees more than the quota
+        capacity = max(1, quota * BURST_SECONDS / 60)
+        return TokenBucket(max(1, quota - capacity), capacity=capacity)
+
+    def set_http_factory(self, http_factory):
+        self.http_factory = http_factory
+
+    def _thread_http(self):
+        if self.http_factory is None:
+            return None
+
+        if getattr(self.thread_local, "http", None) is None:
+            self.thread_local.http = self.http_factory()
+
+        return self.thread_local.http
+
+    def _start_workers(self):
+        # Workers are started lazily on the first submitted request
+        if self.threads:
+            return
+
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"sheets-scheduler-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, request, kind="read", priority=PRIORITY_USER):
+        if kind not in self.buckets:
+            raise ValueError(f"Unknown request kind '{kind}', expected 'read' or 'write'")
+
+        future = Future()
+
+        with self.condition:
+            self._start_workers()
+            heapq.heappush(self.queue, (priority, next(self.counter), request, kind, future))
+            self.condition.notify()
+
+        return future
+
+    def execute(self, request, kind="read", priority=PRIORITY_USER):
+        # Submit the request and block until it has been executed
+        return self.submit(request, kind, priority).result()
+
+    def get_queue_depth(self):
+        with self.condition:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+
+            for priority, *_ in self.queue:
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                depth[name] = depth.get(name, 0) + 1
+
+            depth["total"] = len(self.queue)
+            return depth
+
+    def _backoff_delay(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _run(self, request, kind):
+        attempt = 0
+
+        while True:
+            self.buckets[kind].acquire()
+
+            try:
+                return request.execute(http=self._thread_http())
+            except HttpError as e:
+                if e.resp.status not in RETRYABLE_STATUSES or attempt >= self.max_retries:
+                    raise
+
+                delay = self._backoff_delay(attempt)
+                logger.error(f"Sheets {kind} request failed with status {e.resp.status}, retrying in {delay:.2f}s (attempt {attempt + 1}/{self.max_retries})")
+
+                time.sleep(delay)
+                attempt += 1
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+
+                _, _, request, kind, future = heapq.heappop(self.queue)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(self._run(request, kind))
+            except Exception as e:
+                future.set_exception(e)
+
+
+sheets_scheduler = SheetsScheduler(
+    read_quota=int(os.getenv("SHEETS_READ_QUOTA_PER_MINUTE", "60")) / PROCESS_COUNT,
+    write_quota=int(os.getenv("SHEETS_WRITE_QUOTA_PER_MINUTE", "60")) / PROCESS_COUNT,
+    workers=int(os.getenv("SHEETS_SCHEDULER_WORKERS", "4"))
+)
+
+
+def execute_request(request, kind="read", priority=PRIORITY_USER):
+    return sheets_scheduler.execute(request, kind, priority)
+
+
+def set_http_factory(http_factory):
+    sheets_scheduler.set_http_factory(http_factory)
+
+
+def get_queue_depth():
+    return sheets_scheduler.get_queue_depth()
+
+
+worker_queue_depths = None  # Set in a fleet's intake process to return the queue depth each worker last reported
+
+
+def set_worker_queue_depths(source):
+    global worker_queue_depths
+    worker_queue_depths = source
+
+
+def get_worker_queue_depths():
+    return worker_queue_depths() if worker_queue_depths else {}